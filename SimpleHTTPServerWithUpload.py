@@ -21,14 +21,54 @@ import http.server
 import socketserver
 import urllib.request, urllib.parse, urllib.error
 import html
-import shutil
 import mimetypes
 import re
 import argparse
 import base64
+import bisect
+import datetime
+import email.utils
+import errno
+import fnmatch
+import functools
+import hashlib
+import json
+import mmap
+import signal
+import socket
+import stat
+import struct
+import tarfile
+import tempfile
+import threading
+import traceback
+import zlib
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from io import BytesIO
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 def fbytes(B):
    'Return the given bytes as a human friendly KB, MB, GB, or TB string'
    B = float(B)
@@ -48,6 +88,1471 @@ def fbytes(B):
    elif TB <= B:
       return '{0:.2f} TB'.format(B/TB)
 
+def upload_filename(name):
+   'Return the last component of a client-supplied file name, or None if unusable'
+   # Some browsers send the full client-side path.
+   name = name.replace('\\', '/').rsplit('/', 1)[-1]
+   if name in ('', os.curdir, os.pardir) or '\0' in name:
+      return None
+   return name
+
+# Hidden files of uploads in progress: those of a chunked upload session
+# (see UploadSession) and the temporary file of a form upload.
+UPLOAD_TEMP_NAME = re.compile(r'\.(?:[0-9a-f]{32}\.(?:part|map|upload)|.+\.[0-9a-f]{12}\.part)\Z',
+                              re.S)
+
+def upload_temp_name(name):
+   'Return True if NAME is a file of an upload still in progress'
+   return UPLOAD_TEMP_NAME.match(name) is not None
+
+class MultipartError(Exception):
+
+    """An upload that isn't valid multipart/form-data.
+
+    CODE is the HTTP status the request should be answered with.
+
+    """
+
+    def __init__(self, message, code=400):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class MultipartParser:
+
+    """Incremental parser for a multipart/form-data request body.
+
+    At most LENGTH bytes are read from RFILE, in blocks of BUFSIZE
+    bytes.  Each block is searched for the boundary as a whole, and a
+    tail one byte shorter than the delimiter is carried over so a
+    boundary split across two blocks is still found.  Memory use is
+    therefore bounded by BUFSIZE whatever the size of the files.
+
+    Call next_part() to get the headers of the next part, then
+    read_part() to consume its body.
+
+    """
+
+    max_header_size = 16 * 1024
+
+    def __init__(self, rfile, boundary, length, bufsize=256 * 1024):
+        self.rfile = rfile
+        self.remaining = length
+        self.bufsize = bufsize
+        self.delimiter = b'\r\n--' + boundary
+        # The first boundary isn't preceded by a line break; pretend it is
+        # so that every boundary looks the same.
+        self.buf = bytearray(b'\r\n')
+        self.at_boundary = False
+        self.done = False
+
+    def fill(self):
+        """Append the next block of the body to the buffer.
+
+        Return False once the whole body has been read.
+
+        """
+        if self.remaining <= 0:
+            return False
+        data = self.rfile.read(min(self.bufsize, self.remaining))
+        if not data:
+            raise MultipartError("Upload ended before Content-Length bytes were sent")
+        self.remaining -= len(data)
+        self.buf += data
+        return True
+
+    def find(self, sub, limit=None):
+        """Return the offset of SUB in the buffer, reading more as needed."""
+        start = 0
+        while True:
+            index = self.buf.find(sub, start)
+            if index >= 0:
+                return index
+            start = max(len(self.buf) - len(sub) + 1, 0)
+            if limit is not None and start > limit:
+                raise MultipartError("Part headers too long")
+            if not self.fill():
+                raise MultipartError("Content NOT terminated by closing boundary")
+
+    def consume(self, n, out=None):
+        """Drop the first N bytes of the buffer, writing them to OUT if given."""
+        if out is not None:
+            with memoryview(self.buf) as view, view[:n] as chunk:
+                out.write(chunk)
+        del self.buf[:n]
+
+    def next_part(self):
+        """Skip to the next part and return its headers.
+
+        Header names are lower-cased.  Return None after the closing
+        boundary, once the rest of the body has been drained.
+
+        """
+        if self.done:
+            return None
+        if not self.at_boundary:
+            # Skip the preamble, or the unread body of the previous part.
+            self.read_part(None)
+        while len(self.buf) < 2:
+            if not self.fill():
+                raise MultipartError("Content NOT terminated by closing boundary")
+        if self.buf.startswith(b'--'):
+            self.done = True
+            self.buf.clear()
+            while self.fill():
+                self.buf.clear()
+            return None
+        eol = self.find(b'\r\n', self.max_header_size)
+        end = self.find(b'\r\n\r\n', self.max_header_size)
+        if self.buf[:eol].strip(b' \t'):
+            raise MultipartError("Malformed boundary line")
+        headers = {}
+        for line in bytes(self.buf[eol + 2:end]).decode('utf-8', 'replace').split('\r\n'):
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise MultipartError("Malformed part header")
+            headers[name.strip().lower()] = value.strip()
+        self.consume(end + 4)
+        self.at_boundary = False
+        return headers
+
+    def read_part(self, out):
+        """Copy the rest of the current part to OUT, or discard it if None."""
+        delimiter = self.delimiter
+        keep = len(delimiter) - 1
+        while True:
+            index = self.buf.find(delimiter)
+            if index >= 0:
+                self.consume(index, out)
+                self.consume(len(delimiter))
+                self.at_boundary = True
+                return
+            if len(self.buf) > keep:
+                self.consume(len(self.buf) - keep, out)
+            if not self.fill():
+                raise MultipartError("Content NOT terminated by closing boundary")
+
+
+def file_etag(st):
+   'Return a strong ETag built from the inode, size and mtime of a stat result'
+   return '"%x-%x-%x"' % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def weak_etag(etag):
+   'Return ETAG without any W/ prefix, for weak comparison'
+   return etag[2:] if etag.startswith('W/') else etag
+
+def entry_stat(entry):
+   'Return the stat() result of a DirEntry, or None for a dangling link'
+   try:
+      return entry.stat()
+   except OSError:
+      return None
+
+class ChunkedWriter:
+
+    """File-like wrapper writing a response body to WFILE.
+
+    With CHUNKED set every write() becomes one chunk of HTTP/1.1
+    chunked transfer encoding and close() writes the final empty chunk;
+    otherwise data is passed straight through.  close() does not close
+    WFILE.
+
+    """
+
+    def __init__(self, wfile, chunked=True):
+        self.wfile = wfile
+        self.chunked = chunked
+
+    def write(self, data):
+        if not data:
+            return 0
+        if self.chunked:
+            self.wfile.write(b"%x\r\n" % len(data))
+            self.wfile.write(data)
+            self.wfile.write(b"\r\n")
+        else:
+            self.wfile.write(data)
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def close(self):
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+            self.chunked = False
+
+# Content codings the server can produce itself, in order of preference.
+COMPRESSORS = OrderedDict()
+if zstandard is not None:
+    COMPRESSORS['zstd'] = lambda: zstandard.ZstdCompressor(level=3).compressobj()
+if brotli is not None:
+    class BrotliCompressor:
+        'Give brotli.Compressor the compress()/flush() interface of zlib'
+        def __init__(self):
+            self.compressor = brotli.Compressor(quality=5)
+        def compress(self, data):
+            return self.compressor.process(data)
+        def flush(self):
+            return self.compressor.finish()
+    COMPRESSORS['br'] = BrotliCompressor
+COMPRESSORS['gzip'] = lambda: zlib.compressobj(6, zlib.DEFLATED, 31)
+
+# Suffixes of precompressed files served in place of the original.
+PRECOMPRESSED = OrderedDict([('zstd', '.zst'), ('br', '.br'), ('gzip', '.gz')])
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript', 'application/json', 'application/xml',
+    'application/x-javascript', 'application/x-sh', 'application/x-tex',
+    'application/postscript', 'image/svg+xml', 'image/x-ms-bmp', 'image/bmp',
+}
+
+def compressible(ctype):
+   'Return True if content of type CTYPE is worth compressing'
+   ctype = ctype.split(';', 1)[0].strip().lower()
+   return (ctype.startswith('text/') or ctype in COMPRESSIBLE_TYPES
+           or ctype.endswith(('+xml', '+json')))
+
+def accepted_encodings(header, available):
+   """Return the codings in AVAILABLE the Accept-Encoding HEADER allows.
+
+   They are ordered by the client's q-values, ties broken by the order
+   of AVAILABLE.  Codings with q=0, or only matched by a "*;q=0", are
+   left out.
+
+   """
+   qvalues = {}
+   for item in (header or '').split(','):
+      coding, _, params = item.partition(';')
+      coding = coding.strip().lower()
+      if not coding:
+         continue
+      q = 1.0
+      for param in params.split(';'):
+         name, _, value = param.partition('=')
+         if name.strip().lower() == 'q':
+            try:
+               q = float(value)
+            except ValueError:
+               q = 0.0
+      qvalues['gzip' if coding == 'x-gzip' else coding] = q
+   default = qvalues.get('*', 0.0)
+   ranked = [(-qvalues.get(coding, default), i, coding)
+             for i, coding in enumerate(available)]
+   return [coding for q, i, coding in sorted(ranked) if q < 0]
+
+class CompressingWriter:
+
+    """File-like wrapper compressing everything written to OUT.
+
+    Compressed output is also written to CACHE_FILE, if given, which
+    is committed by close() and discarded by abort().
+
+    """
+
+    def __init__(self, out, compressor, cache_file=None):
+        self.out = out
+        self.compressor = compressor
+        self.cache_file = cache_file
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.out.write(data)
+            if self.cache_file is not None:
+                self.cache_file.write(data)
+        return len(data)
+
+    def close(self):
+        data = self.compressor.flush()
+        self.out.write(data)
+        self.out.close()
+        if self.cache_file is not None:
+            self.cache_file.write(data)
+            self.cache_file.commit()
+
+    def abort(self):
+        if self.cache_file is not None:
+            self.cache_file.abort()
+
+class VariantCache:
+
+    """Size-bounded on-disk LRU cache of derived versions of files.
+
+    Variants, such as compressed copies or thumbnails, are stored in
+    DIRECTORY under a hash of the source path, size, mtime and variant
+    name, so a modified source simply misses and its stale variants
+    age out.  Recency is kept in the files' mtimes, so the eviction
+    order survives restarts.  Once the variants add up to more than
+    MAX_BYTES the least recently used are deleted.
+
+    A SHARED cache is used by several processes at once, each with its
+    own index: variants missing from the index are looked for on disk,
+    and the directory is scanned again before evicting, so that the
+    limit holds for the variants of all processes together.
+
+    Only files named like variants are ever indexed or deleted, and a
+    directory is only used when it is empty, already holds a cache (as
+    told by its marker file) or nothing but variants; anything else
+    raises ValueError.
+
+    """
+
+    marker = '.variant-cache'
+    variant_name = re.compile(r'[0-9a-f]{40}\Z')
+    part_name = re.compile(r'[0-9a-f]{40}\.[0-9a-f]+\.part\Z')
+
+    def __init__(self, directory, max_bytes, shared=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        names = os.listdir(directory)
+        if self.marker not in names:
+            if any(not self.variant_name.match(name) and not self.part_name.match(name)
+                   for name in names):
+                raise ValueError("%s is not empty and holds no cache" % directory)
+            with open(os.path.join(directory, self.marker), 'w'):
+                pass
+        for name in names:
+            if self.part_name.match(name):
+                # left over from an interrupted run
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+        with self.lock:
+            self.scan()
+            self.evict()
+
+    def scan(self):
+        """Rebuild the index from the directory; the caller holds the lock."""
+        found = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not self.variant_name.match(entry.name):
+                    continue
+                st = entry_stat(entry)
+                if st is not None and entry.is_file():
+                    found.append((st.st_mtime, entry.name, st.st_size))
+        self.entries.clear()
+        self.size = 0
+        for mtime, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+
+    def key(self, path, st, variant):
+        key = '%s\0%d\0%d\0%s' % (path, st.st_size, st.st_mtime_ns, variant)
+        return hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def open(self, path, st, variant):
+        """Return the cached variant of PATH opened for reading, or None."""
+        name = self.key(path, st, variant)
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+            elif not self.shared:
+                return None
+        filename = os.path.join(self.directory, name)
+        try:
+            f = open(filename, 'rb')
+            os.utime(filename)
+            size = os.fstat(f.fileno()).st_size
+        except OSError:
+            with self.lock:
+                self.size -= self.entries.pop(name, 0)
+            return None
+        with self.lock:
+            if name not in self.entries:
+                # made by another process
+                self.entries[name] = size
+                self.size += size
+        return f
+
+    def create(self, path, st, variant):
+        """Return a VariantCacheFile for a new variant, or None."""
+        name = self.key(path, st, variant)
+        tmpname = os.path.join(self.directory, '%s.%s.part' % (name, os.urandom(4).hex()))
+        try:
+            return VariantCacheFile(self, name, tmpname)
+        except OSError:
+            return None
+
+    def add(self, name, tmpname, size):
+        """Move a completed variant into place and evict as needed."""
+        os.replace(tmpname, os.path.join(self.directory, name))
+        with self.lock:
+            if self.shared:
+                self.scan()
+            else:
+                self.size -= self.entries.pop(name, 0)
+                self.entries[name] = size
+                self.size += size
+            self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+class VariantCacheFile:
+
+    """A variant being written into a VariantCache.
+
+    Writing stops, and the variant is dropped, once it grows beyond the
+    size of the whole cache.
+
+    """
+
+    def __init__(self, cache, name, tmpname):
+        self.cache = cache
+        self.name = name
+        self.tmpname = tmpname
+        self.size = 0
+        self.file = open(tmpname, 'xb')
+
+    def write(self, data):
+        if self.file is None:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_bytes:
+            self.abort()
+            return
+        self.file.write(data)
+
+    def commit(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        self.cache.add(self.name, self.tmpname, self.size)
+
+    def abort(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.unlink(self.tmpname)
+
+class ThumbnailGenerator:
+
+    """Makes SIZE pixel JPEG thumbnails of images, kept in a VariantCache.
+
+    Thumbnails are made by a pool of WORKERS background threads, so at
+    most that many cores are ever busy scaling images and other
+    requests keep being served meanwhile.  Concurrent requests for the
+    same thumbnail share one job.  Images that can't be decoded are
+    remembered and not tried again until they change.
+
+    """
+
+    max_failures = 4096
+
+    def __init__(self, cache, size=48, workers=2):
+        self.cache = cache
+        self.size = size
+        self.variant = 'thumbnail-%d' % size
+        self.pool = ThreadPoolExecutor(max_workers=workers,
+                                       thread_name_prefix='thumbnail')
+        self.pending = {}
+        self.failed = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, st, timeout=30):
+        """Return the thumbnail of PATH opened for reading, or None.
+
+        ST is the stat result of PATH.  Wait up to TIMEOUT seconds for a
+        thumbnail that isn't cached yet.
+
+        """
+        f = self.cache.open(path, st, self.variant)
+        if f is not None:
+            return f
+        name = self.cache.key(path, st, self.variant)
+        with self.lock:
+            if name in self.failed:
+                return None
+            future = self.pending.get(name)
+            if future is None:
+                future = self.pool.submit(self.generate, path, st, name)
+                self.pending[name] = future
+        try:
+            future.result(timeout)
+        except Exception:
+            return None
+        return self.cache.open(path, st, self.variant)
+
+    def generate(self, path, st, name):
+        """Scale the image PATH down into the cache (in a pool thread)."""
+        try:
+            with Image.open(path) as img:
+                # lets JPEG decode at a fraction of the full resolution
+                img.draft('RGB', (self.size, self.size))
+                img.thumbnail((self.size, self.size))
+                if img.mode in ('RGBA', 'LA', 'P'):
+                    img = img.convert('RGBA')
+                    background = Image.new('RGB', img.size, (255, 255, 255))
+                    background.paste(img, mask=img.split()[-1])
+                    img = background
+                elif img.mode != 'RGB':
+                    img = img.convert('RGB')
+                out = BytesIO()
+                img.save(out, 'JPEG', quality=85)
+            cache_file = self.cache.create(path, st, self.variant)
+            if cache_file is not None:
+                cache_file.write(out.getvalue())
+                cache_file.commit()
+        except Exception:
+            with self.lock:
+                self.failed[name] = True
+                while len(self.failed) > self.max_failures:
+                    self.failed.popitem(last=False)
+            raise
+        finally:
+            with self.lock:
+                self.pending.pop(name, None)
+
+def walk_tree(root):
+   """Return (relative path, path, stat result) for everything below ROOT.
+
+   Directories come before their contents and names are sorted.
+   Files of uploads still in progress are left out.
+   Symbolic links to directories are not followed, so a link loop
+   can't make the walk endless; unreadable entries are skipped.
+
+   """
+   found = []
+   stack = ['']
+   while stack:
+      reldir = stack.pop()
+      try:
+         with os.scandir(os.path.join(root, reldir)) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+      except OSError:
+         continue
+      subdirs = []
+      for entry in entries:
+         if upload_temp_name(entry.name):
+            continue
+         st = entry_stat(entry)
+         if st is None:
+            continue
+         relpath = posixpath.join(reldir, entry.name)
+         if entry.is_dir(follow_symlinks=False):
+            found.append((relpath, entry.path, st))
+            subdirs.append(relpath)
+         elif stat.S_ISREG(st.st_mode):
+            found.append((relpath, entry.path, st))
+      stack.extend(reversed(subdirs))
+   return found
+
+def dos_datetime(timestamp):
+   'Return the MS-DOS (time, date) pair ZIP uses for TIMESTAMP'
+   t = time.localtime(timestamp)
+   if t.tm_year < 1980:
+      return 0, (1 << 5) | 1
+   return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+           ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+class ZipStream:
+
+    """Writes a ZIP archive to OUT front to back, without seeking.
+
+    Each member's CRC and sizes follow its data in a data descriptor,
+    and ZIP64 records are used where sizes or offsets need them, which
+    depends only on the sizes given to add().  With OUT set to None
+    nothing is read or written; such a dry run of a stored archive
+    yields its exact length in self.offset, ready for Content-Length.
+
+    Members are always sent with the size they were listed with: a
+    file that has since grown is cut short and one that has shrunk is
+    padded with zeros, so the predicted length holds.
+
+    """
+
+    # Members this big get ZIP64 sizes.  Leaves room for deflate to
+    # expand incompressible data without overflowing 32 bits.
+    zip64_limit = 0xF0000000
+
+    def __init__(self, out, deflate=False, bufsize=1024 * 1024):
+        self.out = out
+        self.deflate = deflate
+        self.bufsize = bufsize
+        self.offset = 0
+        self.members = []
+
+    def write(self, data):
+        if self.out is not None:
+            self.out.write(data)
+        self.offset += len(data)
+
+    def add(self, arcname, path, st):
+        """Append the file or directory PATH, with stat result ST, as ARCNAME."""
+        is_dir = stat.S_ISDIR(st.st_mode)
+        name = (arcname + '/' if is_dir else arcname).encode('utf-8', 'surrogateescape')
+        size = 0 if is_dir else st.st_size
+        zip64 = size >= self.zip64_limit
+        method = zipmethod = 8 if self.deflate and not is_dir else 0
+        flags = 0x08 | 0x800    # data descriptor, UTF-8 name
+        dostime, dosdate = dos_datetime(st.st_mtime)
+        offset = self.offset
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        self.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20,
+                               flags, method, dostime, dosdate, 0,
+                               0xFFFFFFFF if zip64 else 0,
+                               0xFFFFFFFF if zip64 else 0,
+                               len(name), len(extra)) + name + extra)
+        crc, compressed = self.write_data(path, size, method)
+        if zip64:
+            self.write(struct.pack('<IIQQ', 0x08074b50, crc, compressed, size))
+        else:
+            self.write(struct.pack('<IIII', 0x08074b50, crc, compressed, size))
+        attr = (stat.S_IMODE(st.st_mode) | stat.S_IFMT(st.st_mode)) << 16
+        if is_dir:
+            attr |= 0x10
+        self.members.append((name, flags, zipmethod, dostime, dosdate, crc,
+                             compressed, size, offset, attr))
+
+    def write_data(self, path, size, method):
+        """Write SIZE bytes of PATH; return their CRC and stored size."""
+        if self.out is None:
+            self.offset += size
+            return 0, size
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if method else None
+        crc = compressed = 0
+        remaining = size
+        view = memoryview(bytearray(min(self.bufsize, max(size, 1))))
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            f = BytesIO()
+        with f:
+            while remaining > 0:
+                chunk = view[:min(remaining, len(view))]
+                n = f.readinto(chunk)
+                if not n:
+                    # the file shrank since it was listed
+                    n = len(chunk)
+                    chunk[:] = bytes(n)
+                chunk = chunk[:n]
+                crc = zlib.crc32(chunk, crc)
+                remaining -= n
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                self.write(chunk)
+                compressed += len(chunk)
+        if compressor is not None:
+            data = compressor.flush()
+            self.write(data)
+            compressed += len(data)
+        return crc, compressed
+
+    def close(self):
+        """Write the central directory and the end records."""
+        cd_offset = self.offset
+        for (name, flags, method, dostime, dosdate, crc, compressed, size,
+             offset, attr) in self.members:
+            fields = []
+            if size >= self.zip64_limit or compressed >= 0xFFFFFFFF:
+                fields += [size, compressed]
+                size = compressed = 0xFFFFFFFF
+            if offset >= 0xFFFFFFFF:
+                fields.append(offset)
+                offset = 0xFFFFFFFF
+            extra = b''
+            if fields:
+                extra = struct.pack('<HH%dQ' % len(fields), 1, 8 * len(fields), *fields)
+            version = 45 if fields else 20
+            self.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50,
+                                   (3 << 8) | version, version, flags, method,
+                                   dostime, dosdate, crc, compressed, size,
+                                   len(name), len(extra), 0, 0, 0, attr, offset)
+                       + name + extra)
+        cd_size = self.offset - cd_offset
+        count = len(self.members)
+        if count >= 0xFFFF or cd_offset >= 0xFFFFFFFF or cd_size >= 0xFFFFFFFF:
+            eocd64_offset = self.offset
+            self.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45,
+                                   0, 0, count, count, cd_size, cd_offset))
+            self.write(struct.pack('<IIQI', 0x07064b50, 0, eocd64_offset, 1))
+        self.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0,
+                               min(count, 0xFFFF), min(count, 0xFFFF),
+                               min(cd_size, 0xFFFFFFFF),
+                               min(cd_offset, 0xFFFFFFFF), 0))
+
+class TarStream:
+
+    """Writes a POSIX (pax) tar archive to OUT front to back.
+
+    File data is copied with COPYFILE(source, out, count), so it can go
+    out with sendfile().  As with ZipStream, OUT set to None makes a dry
+    run whose self.offset is the exact length of the archive, and
+    members are always sent with the size they were listed with.
+
+    """
+
+    def __init__(self, out, copyfile=None):
+        self.out = out
+        self.copyfile = copyfile
+        self.offset = 0
+
+    def write(self, data):
+        if self.out is not None:
+            self.out.write(data)
+        self.offset += len(data)
+
+    def write_zeros(self, n):
+        if self.out is None:
+            self.offset += n
+            return
+        while n > 0:
+            self.write(bytes(min(n, 1024 * 1024)))
+            n -= 1024 * 1024
+
+    def add(self, arcname, path, st):
+        """Append the file or directory PATH, with stat result ST, as ARCNAME."""
+        info = tarfile.TarInfo(arcname)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = int(st.st_mtime)
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        else:
+            info.size = st.st_size
+        self.write(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+        if not info.size:
+            return
+        copied = 0
+        if self.out is not None:
+            try:
+                with open(path, 'rb') as f:
+                    copied = self.copyfile(f, self.out, info.size)
+            except OSError:
+                pass
+        self.offset += copied
+        # zeros for a file that shrank, then up to a whole block
+        self.write_zeros(info.size - copied + -info.size % tarfile.BLOCKSIZE)
+
+    def close(self):
+        self.write(bytes(2 * tarfile.BLOCKSIZE))
+
+class ListingCache:
+
+    """Size-bounded LRU cache of rendered directory listings.
+
+    Each entry remembers the mtime of its directory, and a lookup with
+    any other mtime misses, so adding, removing or renaming a file
+    invalidates the listing.  Least recently used entries are evicted
+    once the pages add up to more than MAX_BYTES.
+
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, mtime):
+        """Return the page cached for KEY at MTIME, or None."""
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None or item[0] != mtime:
+                return None
+            self.entries.move_to_end(key)
+            return item[1]
+
+    def put(self, key, mtime, page):
+        """Cache PAGE for KEY at MTIME, evicting old entries as needed."""
+        if len(page) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[key] = (mtime, page)
+            self.size += len(page)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class UploadSession:
+
+    """A chunked upload of one file into DIRECTORY, kept entirely on disk.
+
+    A session is three hidden files next to its target: ".ID.upload"
+    holds the target name, size and chunk size as JSON, ".ID.part" is
+    the target preallocated to its full size, into which chunks are
+    written in place, and ".ID.map" has one byte per chunk, set once
+    that chunk is stored.  As nothing is kept in memory, chunks of one
+    upload can arrive in parallel on any thread or process, and an
+    upload can be resumed after a restart.
+
+    """
+
+    id_pattern = re.compile(r'[0-9a-f]{32}\Z')
+
+    def __init__(self, directory, id):
+        """Open an existing session; raise OSError or ValueError if there is none."""
+        if not self.id_pattern.match(id):
+            raise ValueError("Invalid upload session")
+        self.directory = directory
+        self.id = id
+        with open(self.filename('upload'), 'rb') as f:
+            meta = json.loads(f.read().decode('utf-8'))
+        self.name = meta['name']
+        self.size = meta['size']
+        self.chunk_size = meta['chunk_size']
+        if upload_filename(self.name) != self.name:
+            raise ValueError("Invalid upload session")
+        self.chunks = -(-self.size // self.chunk_size)
+
+    def filename(self, kind):
+        return os.path.join(self.directory, '.%s.%s' % (self.id, kind))
+
+    @classmethod
+    def create(cls, directory, name, size, chunk_size):
+        """Start a session for a SIZE byte file NAME; return it."""
+        id = os.urandom(16).hex()
+        prefix = os.path.join(directory, '.' + id)
+        try:
+            with open(prefix + '.part', 'xb') as f:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except AttributeError:
+                    f.truncate(size)
+                except OSError as e:
+                    if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                        raise
+                    # not supported here; reserve the size without the blocks
+                    f.truncate(size)
+            with open(prefix + '.map', 'xb') as f:
+                f.truncate(-(-size // chunk_size))
+            with open(prefix + '.upload', 'xb') as f:
+                f.write(json.dumps({'name': name, 'size': size,
+                                    'chunk_size': chunk_size}).encode('utf-8'))
+        except OSError:
+            for kind in 'part', 'map', 'upload':
+                try:
+                    os.unlink('%s.%s' % (prefix, kind))
+                except OSError:
+                    pass
+            raise
+        return cls(directory, id)
+
+    @classmethod
+    def expire(cls, directory, max_age):
+        """Remove sessions in DIRECTORY untouched for MAX_AGE seconds."""
+        now = time.time()
+        with os.scandir(directory) as it:
+            for entry in it:
+                name = entry.name
+                if not (name.startswith('.') and name.endswith('.upload')):
+                    continue
+                st = entry_stat(entry)
+                if st is None or now - st.st_mtime < max_age:
+                    continue
+                try:
+                    cls(directory, name[1:-len('.upload')]).abort()
+                except (OSError, ValueError):
+                    pass
+
+    def status(self):
+        """Return the state of the upload as a dict, for JSON."""
+        return {'id': self.id, 'name': self.name, 'size': self.size,
+                'chunk_size': self.chunk_size, 'received': self.received()}
+
+    def chunk_length(self, index):
+        """Return the length of chunk INDEX, or None if out of range."""
+        if not 0 <= index < self.chunks:
+            return None
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def write_chunk(self, index, rfile, bufsize):
+        """Read chunk INDEX from RFILE and store it in place.
+
+        Raise EOFError if RFILE ends before the whole chunk is read.
+
+        """
+        offset = index * self.chunk_size
+        remaining = self.chunk_length(index)
+        view = memoryview(bytearray(min(bufsize, max(remaining, 1))))
+        fd = os.open(self.filename('part'), os.O_WRONLY)
+        try:
+            while remaining > 0:
+                n = rfile.readinto(view[:min(remaining, len(view))])
+                if not n:
+                    raise EOFError("Chunk ended early")
+                written = 0
+                while written < n:
+                    written += os.pwrite(fd, view[written:n], offset + written)
+                offset += n
+                remaining -= n
+        finally:
+            os.close(fd)
+        fd = os.open(self.filename('map'), os.O_WRONLY)
+        try:
+            os.pwrite(fd, b'\x01', index)
+        finally:
+            os.close(fd)
+        os.utime(self.filename('upload'))
+
+    def received(self):
+        """Return the indexes of the chunks stored so far."""
+        with open(self.filename('map'), 'rb') as f:
+            chunk_map = f.read()
+        return [i for i, stored in enumerate(chunk_map) if stored]
+
+    def finalize(self):
+        """Move the completed file into place and end the session.
+
+        Return the path of the file, or None if chunks are missing.
+        If the file can't be moved into place, say because a directory
+        has its name, the session is ended anyway and OSError raised.
+
+        """
+        if len(self.received()) != self.chunks:
+            return None
+        path = os.path.join(self.directory, self.name)
+        try:
+            os.replace(self.filename('part'), path)
+        finally:
+            self.abort()
+        return path
+
+    def abort(self):
+        """Remove whatever is left of the session."""
+        for kind in 'part', 'map', 'upload':
+            try:
+                os.unlink(self.filename(kind))
+            except FileNotFoundError:
+                pass
+
+# Sends the files picked in the listing's upload form as parallel,
+# resumable chunked uploads.  Browsers without fetch() just submit the
+# form, as does any browser the server refuses to start a session for.
+UPLOAD_SCRIPT = b"""<script>
+(function () {
+  var form = document.getElementById('upload');
+  if (!form || !window.fetch || !window.Promise || !window.localStorage) return;
+  var status = document.getElementById('upload-status');
+  var parallel = 4, tries = 3;
+
+  function request(method, url, body) {
+    return fetch(url, {method: method, body: body}).then(function (r) {
+      if (!r.ok) throw new Error(method + ' failed: ' + r.status);
+      return r.status == 204 ? null : r.json();
+    });
+  }
+
+  function retry(fn, n) {
+    return fn().catch(function (err) {
+      if (n <= 1) throw err;
+      return retry(fn, n - 1);
+    });
+  }
+
+  function upload(file, progress) {
+    var key = 'upload:' + location.pathname + ':' + file.name + ':' +
+              file.size + ':' + file.lastModified;
+    var id = localStorage.getItem(key);
+    var resume = id ? request('GET', '?upload-session=' + id)
+                        .catch(function () { return null; })
+                    : Promise.resolve(null);
+    return resume.then(function (session) {
+      return session || request('POST', '?upload-session&name=' +
+                                encodeURIComponent(file.name) + '&size=' + file.size)
+        .catch(function (err) { err.fallback = true; throw err; });
+    }).then(function (session) {
+      localStorage.setItem(key, session.id);
+      var size = session.chunk_size, count = Math.ceil(file.size / size);
+      var done = {}, next = 0, sent = session.received.length;
+      session.received.forEach(function (i) { done[i] = true; });
+      function worker() {
+        while (next < count && done[next]) next++;
+        if (next >= count) return Promise.resolve();
+        var i = next++;
+        var chunk = file.slice(i * size, Math.min(file.size, (i + 1) * size));
+        return retry(function () {
+          return request('PUT', '?upload-session=' + session.id + '&chunk=' + i, chunk);
+        }, tries).then(function () {
+          progress(++sent / count);
+          return worker();
+        });
+      }
+      var workers = [];
+      for (var w = 0; w < parallel; w++) workers.push(worker());
+      return Promise.all(workers).then(function () {
+        return request('POST', '?upload-session=' + session.id + '&finalize');
+      }).then(function () {
+        localStorage.removeItem(key);
+      });
+    });
+  }
+
+  form.addEventListener('submit', function (event) {
+    var files = Array.prototype.slice.call(form.elements.file.files);
+    if (!files.length) return;
+    event.preventDefault();
+    var chain = Promise.resolve();
+    files.forEach(function (file) {
+      chain = chain.then(function () {
+        return upload(file, function (fraction) {
+          status.textContent = file.name + ': ' + Math.floor(fraction * 100) + '%';
+        });
+      });
+    });
+    chain.then(function () {
+      location.reload();
+    }, function (err) {
+      if (err.fallback) {
+        form.submit();
+      } else {
+        status.textContent = err.message + ' - press upload again to resume';
+      }
+    });
+  });
+})();
+</script>
+"""
+
+class ByteCounter:
+
+    """File object wrapper counting the bytes read from or written to it.
+
+    Only the calls the request handler makes are counted; anything else
+    is passed through to the wrapped file.  If THROTTLE is given, it is
+    called with the number of bytes after every transfer and may sleep
+    to hold the rate down.  Writes are then split into pieces of at most
+    CHUNK bytes so that the pauses stay short and even.
+
+    """
+
+    def __init__(self, f, throttle=None, chunk=64 * 1024):
+        self.f = f
+        self.count = 0
+        self.throttle = throttle
+        self.chunk = chunk
+
+    def add(self, n):
+        """Account for N bytes transferred behind our back (sendfile)."""
+        self.count += n
+        if self.throttle is not None and n:
+            self.throttle(n)
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        self.add(len(data))
+        return data
+
+    def read1(self, *args):
+        data = self.f.read1(*args)
+        self.add(len(data))
+        return data
+
+    def readline(self, *args):
+        data = self.f.readline(*args)
+        self.add(len(data))
+        return data
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        if n:
+            self.add(n)
+        return n
+
+    def write(self, b):
+        if self.throttle is not None and len(b) > self.chunk:
+            view = memoryview(b).cast('B')
+            for start in range(0, len(view), self.chunk):
+                self.write(view[start:start + self.chunk])
+            return len(view)
+        n = self.f.write(b)
+        self.add(len(b) if n is None else n)
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+class FileLock:
+
+    """Lock for the threads of forked processes alike.
+
+    Processes exclude each other with fcntl.lockf() on a temporary file
+    they all inherit, and the threads of a process with a lock of its
+    own.  The kernel drops the record lock of a process that dies, so a
+    worker killed while holding it can't leave the others waiting
+    forever, as a multiprocessing.Lock would.
+
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            fcntl.lockf(self.file, fcntl.LOCK_EX)
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def __exit__(self, *exc):
+        try:
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
+        finally:
+            self.lock.release()
+
+class Shaper:
+
+    """Token-bucket rate limits and per-client connection limits.
+
+    RATES caps the bytes per second of the whole server and
+    CLIENT_RATES those of each client address, both as dicts from
+    'download' or 'upload' to a rate, 0 meaning unlimited.  A transfer
+    may overdraw a bucket; throttle() then sleeps until the debt is paid
+    back, so transfers waiting on the same bucket take turns and share
+    its rate evenly.  Interactive transfers, the first few hundred
+    kilobytes of a request or response, are charged to the server-wide
+    bucket without waiting for it: listings, icons and small files
+    don't queue up behind bulk transfers, which slow down to make room.
+
+    Clients are told apart by a hash of their address into a table of
+    table_size entries, so two addresses occasionally share limits.
+    MAX_CONNECTIONS bounds the connections open per client.
+
+    The buckets and counters live in an anonymous shared memory map
+    guarded by LOCK, so that forked worker processes enforce the limits
+    together; with workers, LOCK must be a FileLock.  Open
+    connections are counted per process SLOTS, as in Metrics, so that
+    those of a crashed worker are forgotten when its slot is claimed
+    again.
+
+    """
+
+    directions = ('download', 'upload')
+    table_size = 4096
+
+    def __init__(self, rates, client_rates, max_connections=0, slots=1,
+                 lock=None):
+        self.rates = [rates.get(d, 0) for d in self.directions]
+        self.client_rates = [client_rates.get(d, 0) for d in self.directions]
+        self.max_connections = max_connections
+        self.slots = slots
+        # tokens and time of last refill for each bucket: the server's,
+        # then table_size clients', for each direction
+        self.buckets = 2 * len(self.directions) * (1 + self.table_size)
+        self.memory = mmap.mmap(-1, 8 * (self.buckets + slots * self.table_size))
+        self.values = memoryview(self.memory).cast('d')
+        self.base = self.buckets
+        self.lock = lock or threading.Lock()
+
+    def limited(self, direction):
+        i = self.directions.index(direction)
+        return bool(self.rates[i] or self.client_rates[i])
+
+    def client(self, address):
+        """Return the table index of client ADDRESS."""
+        return zlib.crc32(address.encode('utf-8', 'replace')) % self.table_size
+
+    def claim(self, slot):
+        """Count connections in SLOT, which starts with none."""
+        self.base = self.buckets + slot * self.table_size
+        self.values[self.base:self.base + self.table_size] = \
+            memoryview(bytes(8 * self.table_size)).cast('d')
+
+    def connect(self, client):
+        """Count a new connection; return False if the client has too many."""
+        values = self.values
+        with self.lock:
+            if self.max_connections:
+                open_connections = sum(values[self.buckets + slot * self.table_size + client]
+                                       for slot in range(self.slots))
+                if open_connections >= self.max_connections:
+                    return False
+            values[self.base + client] += 1
+        return True
+
+    def disconnect(self, client):
+        with self.lock:
+            self.values[self.base + client] -= 1
+
+    def take(self, i, rate, nbytes, now):
+        """Take NBYTES from bucket I filled at RATE; return the time to
+        wait until the bucket is out of debt."""
+        values = self.values
+        burst = max(64 * 1024, rate / 10)
+        tokens = min(burst, values[i] + (now - values[i + 1]) * rate) - nbytes
+        values[i] = tokens
+        values[i + 1] = now
+        return -tokens / rate if tokens < 0 else 0.0
+
+    def throttle(self, direction, client, nbytes, interactive=False):
+        """Charge a transfer of NBYTES and sleep as the limits require."""
+        d = self.directions.index(direction)
+        rate = self.rates[d]
+        client_rate = self.client_rates[d]
+        delay = 0.0
+        with self.lock:
+            now = time.monotonic()
+            if rate:
+                wait = self.take(2 * d, rate, nbytes, now)
+                if not interactive:
+                    delay = wait
+            if client_rate:
+                i = 2 * len(self.directions) * (1 + client) + 2 * d
+                delay = max(delay, self.take(i, client_rate, nbytes, now))
+        if delay > 0:
+            time.sleep(delay)
+
+class Metrics:
+
+    """Request statistics, rendered in the Prometheus text format.
+
+    Every value is a float in an anonymous shared memory map, so the
+    numbers of forked worker processes add up: each process writes only
+    to its own slot, chosen with claim(), and render() sums all SLOTS.
+    Within a process a lock keeps concurrent updates from getting lost.
+
+    """
+
+    methods = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'other')
+    codes = ('1xx', '2xx', '3xx', '4xx', '5xx', 'none')
+    directions = ('download', 'upload')
+    latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                       0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    throughput_buckets = tuple(float(2 ** n) for n in range(16, 36, 2))
+
+    # Transfers shorter than this say more about latency than throughput
+    # and are left out of the throughput histogram.
+    min_transfer = 64 * 1024
+
+    def __init__(self, slots=1):
+        self.series = []
+        self.offsets = {}
+        self.size = 0
+        self.define('http_requests_total', 'counter',
+                    'Requests answered, by method and status class',
+                    ('method', 'code'),
+                    [(m, c) for m in self.methods for c in self.codes])
+        self.define('http_request_duration_seconds', 'histogram',
+                    'Time taken to answer a request', ('method',),
+                    [(m,) for m in self.methods], self.latency_buckets)
+        self.define('http_requests_in_flight', 'gauge',
+                    'Requests being answered')
+        self.define('http_rejected_connections_total', 'counter',
+                    'Connections turned away because the queue was full '
+                    'or the client had too many open')
+        self.define('http_sent_bytes_total', 'counter',
+                    'Bytes sent to clients, headers included')
+        self.define('http_received_bytes_total', 'counter',
+                    'Bytes received from clients, headers included')
+        self.define('http_listing_duration_seconds', 'histogram',
+                    'Time taken to send a directory listing',
+                    buckets=self.latency_buckets)
+        self.define('http_transfer_bytes_total', 'counter',
+                    'Body bytes sent by copyfile() or stored from uploads', ('direction',),
+                    [(d,) for d in self.directions])
+        self.define('http_transfer_seconds_total', 'counter',
+                    'Time spent sending or storing those bytes', ('direction',),
+                    [(d,) for d in self.directions])
+        self.define('http_transfer_throughput_bytes_per_second', 'histogram',
+                    'Speed of transfers of at least %d bytes' % self.min_transfer,
+                    ('direction',), [(d,) for d in self.directions],
+                    self.throughput_buckets)
+        self.slots = slots
+        self.memory = mmap.mmap(-1, 8 * self.size * slots)
+        self.values = memoryview(self.memory).cast('d')
+        self.base = 0
+        self.lock = threading.Lock()
+
+    def define(self, name, kind, help, labels=(), values=((),), buckets=None):
+        """Add a metric with a series for each tuple of label VALUES."""
+        width = 1 if buckets is None else len(buckets) + 2
+        self.series.append((name, kind, help, labels, values, buckets))
+        for value in values:
+            self.offsets[name, value] = self.size
+            self.size += width
+
+    def claim(self, slot):
+        """Make this process record into SLOT, which starts with no
+        requests in flight.  Counters carry on from an earlier process
+        in the same slot."""
+        self.base = slot * self.size
+        self.values[self.base + self.offsets['http_requests_in_flight', ()]] = 0
+
+    def index(self, name, labels=()):
+        return self.base + self.offsets[name, labels]
+
+    def observe(self, name, labels, buckets, value):
+        """Add VALUE to a histogram; the caller holds the lock."""
+        i = self.index(name, labels)
+        self.values[i + bisect.bisect_left(buckets, value)] += 1
+        self.values[i + len(buckets) + 1] += value
+
+    def add(self, name, value=1, labels=()):
+        with self.lock:
+            self.values[self.index(name, labels)] += value
+
+    def request_finished(self, method, code, seconds, sent, received):
+        if method not in self.methods:
+            method = 'other'
+        code = '%dxx' % (code // 100) if code and 100 <= code < 600 else 'none'
+        values = self.values
+        with self.lock:
+            values[self.index('http_requests_total', (method, code))] += 1
+            values[self.index('http_requests_in_flight')] -= 1
+            values[self.index('http_sent_bytes_total')] += sent
+            values[self.index('http_received_bytes_total')] += received
+            self.observe('http_request_duration_seconds', (method,),
+                         self.latency_buckets, seconds)
+
+    def listing_finished(self, seconds):
+        with self.lock:
+            self.observe('http_listing_duration_seconds', (),
+                         self.latency_buckets, seconds)
+
+    def transfer_finished(self, direction, nbytes, seconds):
+        labels = (direction,)
+        with self.lock:
+            self.values[self.index('http_transfer_bytes_total', labels)] += nbytes
+            self.values[self.index('http_transfer_seconds_total', labels)] += seconds
+            if nbytes >= self.min_transfer and seconds > 0:
+                self.observe('http_transfer_throughput_bytes_per_second',
+                             labels, self.throughput_buckets, nbytes / seconds)
+
+    def render(self):
+        """Return the sum over all slots in the Prometheus text format."""
+        totals = [0.0] * self.size
+        for slot in range(self.slots):
+            base = slot * self.size
+            for i, value in enumerate(self.values[base:base + self.size]):
+                totals[i] += value
+        lines = []
+        for name, kind, help, labels, values, buckets in self.series:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for value in values:
+                pairs = ['%s="%s"' % pair for pair in zip(labels, value)]
+                i = self.offsets[name, value]
+                if buckets is None:
+                    lines.append('%s%s %s' % (name, self.labels(pairs),
+                                              self.number(totals[i])))
+                    continue
+                count = 0
+                for le, n in zip(buckets + ('+Inf',), totals[i:]):
+                    count += n
+                    le = le if le == '+Inf' else self.number(le)
+                    lines.append('%s_bucket%s %s' % (
+                        name, self.labels(pairs + ['le="%s"' % le]),
+                        self.number(count)))
+                lines.append('%s_sum%s %s' % (name, self.labels(pairs),
+                                              self.number(totals[i + len(buckets) + 1])))
+                lines.append('%s_count%s %s' % (name, self.labels(pairs),
+                                                self.number(count)))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    @staticmethod
+    def labels(pairs):
+        return '{%s}' % ','.join(pairs) if pairs else ''
+
+    @staticmethod
+    def number(value):
+        return '%d' % value if float(value).is_integer() else repr(float(value))
+
+class StackSampler:
+
+    """Opt-in sampling profiler.
+
+    Every INTERVAL seconds a background thread records the call stack
+    of every other thread.  The counts are written to PATH in the
+    "collapsed" format understood by flamegraph.pl and speedscope, one
+    line per distinct stack: the frames from the outermost in, joined
+    with semicolons, then the number of samples.  PATH is rewritten
+    every FLUSH_INTERVAL seconds and by stop().
+
+    """
+
+    def __init__(self, path, interval=0.01, flush_interval=10.0):
+        self.path = path
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.counts = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='stack-sampler',
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+    def run(self):
+        flush_at = time.monotonic() + self.flush_interval
+        while not self.stopped.wait(self.interval):
+            self.sample()
+            if time.monotonic() >= flush_at:
+                self.write()
+                flush_at = time.monotonic() + self.flush_interval
+
+    def sample(self):
+        me = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name,
+                                             os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def write(self):
+        tmpname = '%s.%s.tmp' % (self.path, os.urandom(6).hex())
+        try:
+            with open(tmpname, 'w') as f:
+                for stack, count in sorted(self.counts.items()):
+                    f.write('%s %d\n' % (stack, count))
+            os.replace(tmpname, self.path)
+        except OSError as e:
+            sys.stderr.write("can't write profile %s: %s\n" % (self.path, e))
+
+def instrumented(kind):
+    """Decorate a SimpleHTTPRequestHandler method so that its calls are
+    recorded in the handler's metrics and access log.
+
+    KIND is 'request' for the do_* methods, 'listing', 'download' for
+    methods returning the number of bytes they sent, or 'upload' for
+    methods reading a request body.  Without metrics or a JSON access
+    log the method is called directly.
+
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None and self.log_format != 'json':
+                return method(self, *args, **kwargs)
+            return self.measure(kind, method, args, kwargs)
+        return wrapper
+    return decorate
+
 class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
  
     """Simple HTTP request handler with GET/HEAD/POST commands.
@@ -63,23 +1568,171 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
     """
  
     server_version = "SimpleHTTPWithUpload/" + __version__
+
+    # Hand file bodies to the kernel with sendfile() where possible;
+    # otherwise copy them through a reusable buffer of copy_bufsize bytes.
+    use_sendfile = hasattr(os, 'sendfile')
+    copy_bufsize = 1024 * 1024
+
+    # Byte ranges selected by send_head() for a 206 reply, as a list of
+    # (first, last) pairs, and the multipart boundary when there are
+    # several.  Requests asking for more than max_ranges get the whole file.
+    ranges = None
+    range_boundary = None
+    range_ctype = None
+    range_size = None
+    max_ranges = 64
+    range_digits = re.compile(r'[0-9]*\Z')
+
+    # Uploads are read from the socket in blocks of this many bytes.
+    upload_bufsize = 256 * 1024
+
+    # Default chunk size of chunked uploads, and how long an untouched
+    # upload session is kept before its partial file is deleted.
+    upload_chunk_size = 8 * 1024 * 1024
+    upload_session_ttl = 7 * 24 * 3600
+
+    listing_cache = ListingCache()
+
+    # (pattern, value) pairs choosing the Cache-Control header; see
+    # cache_control_for().  Listings default to "no-cache".
+    cache_control = []
+
+    # Compress text responses for clients that accept it, serving
+    # precompressed .zst/.br/.gz siblings where they are up to date.
+    # Variants compressed on the fly are kept in compressed_cache, a
+    # VariantCache, if one is set.
+    compress = True
+    compress_min_size = 1024
+    compressed_cache = None
+
+    # Values of ?archive= for directories: (Content-type, extension).
+    archive_formats = {
+        'zip': ('application/zip', '.zip'),
+        'zip-deflate': ('application/zip', '.zip'),
+        'tar': ('application/x-tar', '.tar'),
+        }
+
+    # A ThumbnailGenerator; when set, listings show image thumbnails
+    # from NAME?thumbnail rather than the full-size images.
+    thumbnails = None
+
+    # Set by send_head() when the body must be written through a
+    # CompressingWriter rather than copied as is.
+    body_writer = None
+
+    # Listings with more entries than this are streamed instead of
+    # being rendered in full before the first byte is sent.
+    listing_stream_threshold = 1000
  
+    # Headers and body go out in separate sends; with Nagle's algorithm
+    # the body of a small response waits for the client's delayed ACK,
+    # which on a persistent connection stalls every request.
+    disable_nagle_algorithm = True
+
+    # A Metrics instance shown at metrics_path, and whether requests are
+    # logged as 'common' log lines or one 'json' object per line.  The
+    # status of the current request is kept for the latter.
+    metrics = None
+    metrics_path = '/metrics'
+    log_format = 'common'
+    status = None
+
+    # A Shaper limiting transfer rates, and how much of each request
+    # and response counts as interactive and is let through ahead of
+    # bulk transfers.  Whether the current request has turned into a
+    # bulk transfer, which a ThreadPoolHTTPServer serves apart.
+    shaper = None
+    interactive_bytes = 256 * 1024
+    bulk = False
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        self.limited = {}
+        if self.shaper is not None:
+            self.client_index = self.shaper.client(self.client_address[0])
+            for direction in self.shaper.directions:
+                self.limited[direction] = self.shaper.limited(direction)
+        throttles = {}
+        for direction in ('download', 'upload'):
+            if self.limited.get(direction) or hasattr(self.server, 'enter_bulk'):
+                throttles[direction] = functools.partial(self.throttle, direction)
+        self.rfile = ByteCounter(self.rfile, throttles.get('upload'))
+        self.wfile = ByteCounter(self.wfile, throttles.get('download'))
+        self.received_mark = self.sent_mark = 0
+        self.request_start = (0, 0)
+
+    def parse_request(self):
+        self.request_start = (self.rfile.count, self.wfile.count)
+        return http.server.BaseHTTPRequestHandler.parse_request(self)
+
+    def handle_one_request(self):
+        try:
+            http.server.BaseHTTPRequestHandler.handle_one_request(self)
+        finally:
+            if self.bulk:
+                self.bulk = False
+                self.server.leave_bulk()
+
+    def throttle(self, direction, nbytes):
+        """Hold the transfer of NBYTES in DIRECTION to the rate limits,
+        and move it aside once it turns out to be a bulk transfer."""
+        if direction == 'upload':
+            done = self.rfile.count - self.request_start[0]
+        else:
+            done = self.wfile.count - self.request_start[1]
+        interactive = done <= self.interactive_bytes
+        if not interactive and not self.bulk and hasattr(self.server, 'enter_bulk'):
+            self.bulk = True
+            self.server.enter_bulk()
+        if self.limited.get(direction):
+            self.shaper.throttle(direction, self.client_index, nbytes, interactive)
+
+    @instrumented('request')
     def do_GET(self):
         """Serve a GET request."""
         f = self.send_head()
         if f:
-            self.copyfile(f, self.wfile)
-            f.close()
+            try:
+                if self.body_writer is not None:
+                    try:
+                        self.copyfile(f, self.body_writer)
+                    except BaseException:
+                        self.body_writer.abort()
+                        raise
+                    self.body_writer.close()
+                elif self.ranges:
+                    self.copy_ranges(f, self.wfile)
+                else:
+                    self.copyfile(f, self.wfile)
+            finally:
+                f.close()
  
+    @instrumented('request')
     def do_HEAD(self):
         """Serve a HEAD request."""
         f = self.send_head()
         if f:
             f.close()
  
+    @instrumented('request')
     def do_POST(self):
         """Serve a POST request."""
-        r, info = self.deal_post_data()
+        if self.upload_session_query() is not None:
+            f = self.upload_session_post()
+            if f:
+                self.copyfile(f, self.wfile)
+                f.close()
+            return
+        try:
+            r, info = self.deal_post_data()
+        except MultipartError as e:
+            try:
+                self.send_error(e.code, str(e))
+            except OSError:
+                # The client hung up mid-upload; nobody to tell.
+                self.close_connection = True
+            return
         print((r, info, "by: ", self.client_address))
         f = BytesIO()
         f.write(b'<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
@@ -102,6 +1755,10 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         f.write(b"here</a>.</small></body>\n</html>\n")
         length = f.tell()
         f.seek(0)
+        if not r:
+            # The rest of the request body was never read, so the
+            # connection can't be reused for another request.
+            self.close_connection = True
         self.send_response(200)
         self.send_header("Content-type", "text/html")
         self.send_header("Content-Length", str(length))
@@ -110,50 +1767,229 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             self.copyfile(f, self.wfile)
             f.close()
 
+    @instrumented('request')
+    def do_PUT(self):
+        """Serve a PUT request: one chunk of a chunked upload."""
+        self.upload_chunk()
+
+    @instrumented('request')
+    def do_PATCH(self):
+        """Serve a PATCH request: the same as PUT."""
+        self.upload_chunk()
+
+    @instrumented('request')
+    def do_DELETE(self):
+        """Serve a DELETE request: abandon a chunked upload."""
+        session = self.open_upload_session()
+        if session:
+            session.abort()
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def upload_session_query(self):
+        """Return the query parameters if the request is about a chunked
+        upload session, else None."""
+        query = self.path.split('#', 1)[0].partition('?')[2]
+        params = urllib.parse.parse_qs(query, keep_blank_values=True)
+        if 'upload-session' not in params:
+            return None
+        return params
+
+    def open_upload_session(self):
+        """Return the UploadSession named in the query string.
+
+        On failure an error is sent and None returned.
+
+        """
+        params = self.upload_session_query()
+        path = self.translate_path(self.path)
+        if params is None or not os.path.isdir(path):
+            self.send_error(404, "No such upload session")
+            return None
+        try:
+            return UploadSession(path, params['upload-session'][-1])
+        except (OSError, ValueError, KeyError):
+            self.send_error(404, "No such upload session")
+            return None
+
+    def upload_session_post(self):
+        """Start (?upload-session&name=&size=) or finish
+        (?upload-session=ID&finalize) a chunked upload.
+
+        Both answer with the state of the session as JSON.
+
+        """
+        params = self.upload_session_query()
+        if self.headers.get('Content-Length', '0') != '0':
+            # parameters travel in the query string; don't read the body
+            self.close_connection = True
+        if params['upload-session'][-1]:
+            session = self.open_upload_session()
+            if session is None:
+                return None
+            if 'finalize' not in params:
+                self.send_error(400, "Nothing to do")
+                return None
+            state = session.status()
+            try:
+                path = session.finalize()
+            except OSError as e:
+                self.send_upload_error(e, 409, "Can't move the upload into place")
+                return None
+            if path is None:
+                return self.send_json(409, state)
+            print((True, "chunked upload of '%s'" % path, "by: ", self.client_address))
+            return self.send_json(200, dict(state, received=list(range(session.chunks))))
+        path = self.translate_path(self.path)
+        if not os.path.isdir(path):
+            self.send_error(404, "Upload target is not a directory")
+            return None
+        name = upload_filename(params.get('name', [''])[-1])
+        try:
+            size = int(params.get('size', [''])[-1])
+            chunk_size = int(params.get('chunk_size', [self.upload_chunk_size])[-1])
+        except ValueError:
+            size = chunk_size = -1
+        if name is None or size < 0 or not 64 * 1024 <= chunk_size <= 64 * 1024 * 1024:
+            self.send_error(400, "Invalid name, size or chunk_size")
+            return None
+        try:
+            UploadSession.expire(path, self.upload_session_ttl)
+            session = UploadSession.create(path, name, size, chunk_size)
+        except OSError as e:
+            self.send_upload_error(e, 403, "Can't create file to write")
+            return None
+        return self.send_json(201, session.status())
+
+    @instrumented('upload')
+    def upload_chunk(self):
+        """Store chunk ?chunk=N of the session ?upload-session=ID.
+
+        The body must be exactly that chunk; it is written straight to
+        its place in the session's preallocated file.
+
+        """
+        session = self.open_upload_session()
+        if session is None:
+            return
+        try:
+            index = int(self.upload_session_query().get('chunk', [''])[-1])
+        except ValueError:
+            index = -1
+        expected = session.chunk_length(index)
+        if expected is None:
+            self.send_error(400, "Invalid chunk number")
+            return
+        if self.headers.get('Content-Length') != str(expected):
+            self.send_error(400, "Chunk %d must be %d bytes" % (index, expected))
+            return
+        try:
+            session.write_chunk(index, self.rfile, self.upload_bufsize)
+        except EOFError:
+            self.close_connection = True
+            return
+        except OSError as e:
+            if isinstance(e, (ConnectionError, socket.timeout)):
+                raise
+            self.close_connection = True
+            self.send_upload_error(e, 500, "Can't store the chunk")
+            return
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_upload_error(self, e, code, message):
+        """Answer a chunked upload request that failed with OSError E.
+
+        A full disk is reported as 507, a file too large for the file
+        system as 413, a session that has disappeared as 404 and a
+        permission problem as 403; anything else gets CODE and MESSAGE.
+
+        """
+        if e.errno in (errno.ENOSPC, getattr(errno, 'EDQUOT', errno.ENOSPC)):
+            self.send_error(507, "Not enough space left for the upload")
+        elif e.errno == errno.EFBIG:
+            self.send_error(413, "File too large for this file system")
+        elif e.errno == errno.ENOENT:
+            self.send_error(404, "No such upload session")
+        elif e.errno in (errno.EACCES, errno.EPERM, errno.EROFS):
+            self.send_error(403, "Can't create file to write")
+        else:
+            self.send_error(code, message)
+
+    def send_json(self, code, obj):
+        """Send OBJ as a JSON response with status CODE.
+
+        Return the body as a file object, as send_head() does.
+
+        """
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        return BytesIO(body)
+
+    @instrumented('upload')
     def deal_post_data(self):
-        uploaded_files = []   
-        content_type = self.headers['content-type']
-        if not content_type:
-            return (False, "Content-Type header doesn't contain boundary")
-        boundary = content_type.split("=")[1].encode()
-        remainbytes = int(self.headers['content-length'])
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        if not boundary in line:
-            return (False, "Content NOT begin with boundary")
-        while remainbytes > 0:
-            line = self.rfile.readline()
-            remainbytes -= len(line)
-            fn = re.findall(r'Content-Disposition.*name="file"; filename="(.*)"', line.decode())
-            if not fn:
-                return (False, "Can't find out file name...")
-            path = self.translate_path(self.path)
-            fn = os.path.join(path, fn[0])
-            line = self.rfile.readline()
-            remainbytes -= len(line)
-            line = self.rfile.readline()
-            remainbytes -= len(line)
+        """Store the files of a multipart/form-data upload.
+
+        The body is parsed incrementally by MultipartParser and each file
+        is streamed into a hidden temporary file next to its target,
+        which is renamed into place only once the file is complete.
+
+        Return (success, info) for the result page.  Malformed requests
+        raise MultipartError and are answered with a 4xx instead.
+
+        """
+        content_type = self.headers['content-type'] or ''
+        boundary = re.search(r'boundary=(?:"([^"]+)"|([^;\s]+))', content_type)
+        if not content_type.startswith('multipart/form-data') or not boundary:
+            raise MultipartError("Content-Type header doesn't contain boundary")
+        boundary = (boundary.group(1) or boundary.group(2)).encode('latin-1')
+        try:
+            length = int(self.headers['content-length'])
+        except (TypeError, ValueError):
+            raise MultipartError("Content-Length required", 411)
+        path = self.translate_path(self.path)
+        if not os.path.isdir(path):
+            raise MultipartError("Upload target is not a directory", 404)
+        parser = MultipartParser(self.rfile, boundary, length, self.upload_bufsize)
+        uploaded_files = []
+        while True:
+            headers = parser.next_part()
+            if headers is None:
+                break
+            disposition = headers.get('content-disposition', '')
+            name = re.findall(r'\bname="([^"]*)"', disposition)
+            fn = re.findall(r'\bfilename="([^"]*)"', disposition)
+            if not name or name[0] != 'file' or not fn or not fn[0]:
+                parser.read_part(None)
+                continue
+            fn = upload_filename(fn[0])
+            if fn is None:
+                raise MultipartError("Invalid file name")
+            fn = os.path.join(path, fn)
+            tmpname = os.path.join(path, '.%s.%s.part' % (os.path.basename(fn),
+                                                          os.urandom(6).hex()))
             try:
-                out = open(fn, 'wb')
+                out = open(tmpname, 'xb')
             except IOError:
                 return (False, "<br><br>Can't create file to write.<br>Do you have permission to write?")
-            else:
-                with out:                    
-                    preline = self.rfile.readline()
-                    remainbytes -= len(preline)
-                    while remainbytes > 0:
-                        line = self.rfile.readline()
-                        remainbytes -= len(line)
-                        if boundary in line:
-                            preline = preline[0:-1]
-                            if preline.endswith(b'\r'):
-                                preline = preline[0:-1]
-                            out.write(preline)
-                            uploaded_files.append(fn)
-                            break
-                        else:
-                            out.write(preline)
-                            preline = line
+            try:
+                with out:
+                    parser.read_part(out)
+                os.replace(tmpname, fn)
+            except BaseException as e:
+                os.unlink(tmpname)
+                if not isinstance(e, OSError) or isinstance(e, (ConnectionError, socket.timeout)):
+                    raise
+                # The disk is full, or the name is taken by a directory.
+                return (False, "<br><br>Can't write '%s': %s"
+                        % (html.escape(fn), html.escape(e.strerror or str(e))))
+            uploaded_files.append(html.escape(fn))
         return (True, "<br><br>'%s'" % "'<br>'".join(uploaded_files))
  
     def send_head(self):
@@ -167,15 +2003,37 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         None, in which case the caller has nothing further to do.
 
         """
+        self.ranges = None
+        self.body_writer = None
+        if (self.metrics is not None and
+                urllib.parse.urlsplit(self.path).path == self.metrics_path):
+            body = self.metrics.render()
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            return BytesIO(body)
         path = self.translate_path(self.path)
         f = None
         if os.path.isdir(path):
-            if not self.path.endswith('/'):
+            parts = urllib.parse.urlsplit(self.path)
+            if not parts.path.endswith('/'):
                 # redirect browser - doing basically what apache does
                 self.send_response(301)
-                self.send_header("Location", self.path + "/")
+                new_parts = (parts[0], parts[1], parts[2] + '/',
+                             parts[3], parts[4])
+                self.send_header("Location", urllib.parse.urlunsplit(new_parts))
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return None
+            query = self.path.split('#', 1)[0].partition('?')[2]
+            archive = urllib.parse.parse_qs(query).get('archive')
+            if archive:
+                return self.send_archive(path, archive[-1])
+            if self.upload_session_query() is not None:
+                session = self.open_upload_session()
+                return session and self.send_json(200, session.status())
             for index in "index.html", "index.htm":
                 index = os.path.join(path, index)
                 if os.path.exists(index):
@@ -184,6 +2042,12 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             else:
                 return self.list_directory(path)
         ctype = self.guess_type(path)
+        if self.thumbnails is not None and ctype.startswith('image/'):
+            query = self.path.split('#', 1)[0].partition('?')[2]
+            if 'thumbnail' in urllib.parse.parse_qs(query, keep_blank_values=True):
+                f = self.send_thumbnail(path)
+                if f is not False:
+                    return f
         try:
             # Always read in binary mode. Opening files in text mode may cause
             # newline translations, making the actual size of the content
@@ -192,33 +2056,546 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         except IOError:
             self.send_error(404, "File not found")
             return None
+        fs = os.fstat(f.fileno())
+        size = fs[6]
+        last_modified = self.date_time_string(fs.st_mtime)
+        etag = file_etag(fs)
+        cache_control = self.cache_control_for(path)
+        vary = self.compress and compressible(ctype)
+        encoding = variant = None
+        if vary:
+            encoding, variant = self.choose_variant(path, fs)
+        if encoding is not None:
+            etag = '%s-%s"' % (etag[:-1], encoding)
+        if self.not_modified(etag, fs.st_mtime):
+            f.close()
+            if variant is not None:
+                variant.close()
+            self.send_response(304)
+            self.send_cache_headers(etag, last_modified, cache_control, vary)
+            self.end_headers()
+            return None
+        if encoding is not None:
+            self.send_response(200)
+            self.send_header("Content-type", ctype)
+            self.send_header("Content-Encoding", encoding)
+            self.send_cache_headers(etag, last_modified, cache_control, vary)
+            if variant is not None:
+                f.close()
+                f = variant
+                self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+                self.end_headers()
+                return f
+            cache_file = None
+            if self.compressed_cache is not None and self.command == 'GET':
+                cache_file = self.compressed_cache.create(path, fs, encoding)
+            self.body_writer = CompressingWriter(self.start_stream(),
+                                                 COMPRESSORS[encoding](),
+                                                 cache_file)
+            return f
+        ranges = None
+        if_range = self.headers.get('If-Range')
+        if if_range is None or if_range.strip() in (last_modified, etag):
+            ranges = self.parse_range(self.headers.get('Range'), size)
+        if ranges == []:
+            f.close()
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        if ranges is None:
+            self.send_response(200)
+            self.send_header("Content-type", ctype)
+            self.send_header("Content-Length", str(size))
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            self.send_response(206)
+            self.send_header("Content-type", ctype)
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (first, last, size))
+            self.send_header("Content-Length", str(last - first + 1))
+            f.seek(first)
+        else:
+            self.range_boundary = os.urandom(16).hex()
+            length = sum(len(self.range_part_header(ctype, r, size)) + r[1] - r[0] + 1
+                         for r in ranges)
+            length += len(self.range_trailer())
+            self.send_response(206)
+            self.send_header("Content-type", "multipart/byteranges; boundary=%s"
+                             % self.range_boundary)
+            self.send_header("Content-Length", str(length))
+            self.range_ctype = ctype
+            self.range_size = size
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_cache_headers(etag, last_modified, cache_control, vary)
+        self.end_headers()
+        self.ranges = ranges
+        return f
+
+    def send_archive(self, path, fmt):
+        """Send the directory PATH as a ZIP or tar archive.
+
+        FMT is "zip" (stored), "zip-deflate" or "tar".  The tree is
+        walked up front, but the archive is built while it is sent and
+        never held in memory or on disk.  Stored ZIP and tar archives
+        have their exact size computed by a dry run and go out with a
+        Content-Length (tar file data with sendfile()); deflated ZIP
+        archives are streamed with chunked encoding.
+
+        Always returns None, the body having been sent for GET.
+
+        """
+        if fmt not in self.archive_formats:
+            self.send_error(400, "Unknown archive format")
+            return None
+        ctype, ext = self.archive_formats[fmt]
+        name = os.path.basename(os.path.normpath(path)) or 'download'
+        members = [(posixpath.join(name, relpath), filename, st)
+                   for relpath, filename, st in walk_tree(path)]
+        def make_archive(out):
+            if fmt == 'tar':
+                return TarStream(out, self.copyfile)
+            return ZipStream(out, deflate=fmt == 'zip-deflate',
+                             bufsize=self.copy_bufsize)
         self.send_response(200)
         self.send_header("Content-type", ctype)
-        fs = os.fstat(f.fileno())
-        self.send_header("Content-Length", str(fs[6]))
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        self.send_header("Content-Disposition", "attachment; filename*=UTF-8''%s"
+                         % urllib.parse.quote(name + ext))
+        if fmt == 'zip-deflate':
+            out = self.start_stream()
+        else:
+            dry_run = make_archive(None)
+            for member in members:
+                dry_run.add(*member)
+            dry_run.close()
+            self.send_header("Content-Length", str(dry_run.offset))
+            self.end_headers()
+            out = self.wfile
+        if self.command == 'HEAD':
+            return None
+        archive = make_archive(out)
+        for member in members:
+            archive.add(*member)
+        archive.close()
+        if out is not self.wfile:
+            out.close()
+        return None
+
+    def send_thumbnail(self, path):
+        """Send the headers for the thumbnail of the image PATH.
+
+        Return the thumbnail file or None as for send_head(), or False
+        if no thumbnail can be made and the image itself should be sent.
+
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        etag = '%s-thumbnail"' % file_etag(st)[:-1]
+        last_modified = self.date_time_string(st.st_mtime)
+        cache_control = self.cache_control_for(path)
+        if self.not_modified(etag, st.st_mtime):
+            self.send_response(304)
+            self.send_cache_headers(etag, last_modified, cache_control)
+            self.end_headers()
+            return None
+        f = self.thumbnails.get(path, st)
+        if f is None:
+            return False
+        self.send_response(200)
+        self.send_header("Content-type", "image/jpeg")
+        self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+        self.send_cache_headers(etag, last_modified, cache_control)
         self.end_headers()
         return f
+
+    def choose_variant(self, path, fs):
+        """Pick a content coding for the file PATH with stat result FS.
+
+        Return (encoding, file): FILE is an open precompressed sibling
+        or cached variant, or None if the body has to be compressed on
+        the fly.  Return (None, None) to send the file unencoded, which
+        is also the case for Range requests and small files.
+
+        """
+        if self.headers.get('Range') is not None:
+            return None, None
+        accept = self.headers.get('Accept-Encoding')
+        for encoding in accepted_encodings(accept, list(PRECOMPRESSED)):
+            try:
+                variant = open(path + PRECOMPRESSED[encoding], 'rb')
+            except OSError:
+                continue
+            if os.fstat(variant.fileno()).st_mtime >= fs.st_mtime:
+                return encoding, variant
+            variant.close()
+        if fs.st_size < self.compress_min_size:
+            return None, None
+        for encoding in accepted_encodings(accept, list(COMPRESSORS)):
+            if self.compressed_cache is not None:
+                variant = self.compressed_cache.open(path, fs, encoding)
+                if variant is not None:
+                    return encoding, variant
+            return encoding, None
+        return None, None
+
+    def not_modified(self, etag, mtime):
+        """Return True if the client's copy, per the request's
+        If-None-Match or If-Modified-Since header, is still current.
+
+        ETags are compared weakly, as If-None-Match requires.  MTIME is
+        None when there is no modification date to compare with.
+
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            if etag is None:
+                return False
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or weak_etag(etag) in map(weak_etag, tags)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is None or mtime is None:
+            return False
+        try:
+            ims = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, IndexError, ValueError, OverflowError):
+            return False
+        if ims.tzinfo is None:
+            ims = ims.replace(tzinfo=datetime.timezone.utc)
+        # Last-Modified only has a resolution of one second.
+        return int(mtime) <= ims.timestamp()
+
+    def cache_control_for(self, path):
+        """Return the Cache-Control value configured for PATH, or None.
+
+        self.cache_control is a list of (pattern, value) pairs, tried in
+        order.  Patterns starting with / are matched against the URL
+        path, others against the file name, with fnmatch rules.
+
+        """
+        urlpath = urllib.parse.unquote(self.path.split('?', 1)[0].split('#', 1)[0])
+        name = os.path.basename(path)
+        for pattern, value in self.cache_control:
+            target = urlpath if pattern.startswith('/') else name
+            if fnmatch.fnmatchcase(target, pattern):
+                return value
+        return None
+
+    def send_cache_headers(self, etag, last_modified, cache_control, vary=False):
+        """Send whichever of ETag, Last-Modified and Cache-Control are set.
+
+        VARY adds "Vary: Accept-Encoding" for responses whose body
+        depends on the content coding.
+
+        """
+        if vary:
+            self.send_header("Vary", "Accept-Encoding")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if last_modified is not None:
+            self.send_header("Last-Modified", last_modified)
+        if cache_control is not None:
+            self.send_header("Cache-Control", cache_control)
+
+    def parse_range(self, header, size):
+        """Parse a Range header against a file of SIZE bytes.
+
+        Return None if the header is absent, malformed or should be
+        ignored (the whole file is sent), an empty list if none of the
+        ranges can be satisfied (416), or else a list of (first, last)
+        byte positions, inclusive, in the order they were requested.
+        Overlapping or adjacent ranges would send some bytes more than
+        once, so they are merged instead, leaving the list in file order
+        (RFC 7233, section 6.1).
+
+        """
+        if not header:
+            return None
+        unit, _, spec = header.partition('=')
+        if unit.strip().lower() != 'bytes':
+            return None
+        specs = spec.split(',')
+        if len(specs) > self.max_ranges:
+            return None
+        ranges = []
+        for spec in specs:
+            first, sep, last = spec.strip().partition('-')
+            if (not sep or not (first or last)
+                    or not self.range_digits.match(first)
+                    or not self.range_digits.match(last)):
+                return None
+            if not first:
+                # suffix range: the final LAST bytes of the file
+                first, last = max(size - int(last), 0), size - 1
+            elif last and int(last) < int(first):
+                return None
+            else:
+                first = int(first)
+                last = min(int(last), size - 1) if last else size - 1
+            if first >= size:
+                continue
+            ranges.append((first, last))
+        merged = sorted(ranges)
+        if any(b[0] <= a[1] + 1 for a, b in zip(merged, merged[1:])):
+            ranges = []
+            for first, last in merged:
+                if ranges and first <= ranges[-1][1] + 1:
+                    ranges[-1] = (ranges[-1][0], max(ranges[-1][1], last))
+                else:
+                    ranges.append((first, last))
+        return ranges
+
+    def range_part_header(self, ctype, byterange, size):
+        """Return the header of one part of a multipart/byteranges body."""
+        return ("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+                % (self.range_boundary, ctype, byterange[0], byterange[1], size)).encode('latin-1')
+
+    def range_trailer(self):
+        return ("\r\n--%s--\r\n" % self.range_boundary).encode('latin-1')
+
+    def copy_ranges(self, source, outputfile):
+        """Copy the ranges chosen by send_head() from SOURCE to OUTPUTFILE.
+
+        Each range is reached with a seek, so skipped bytes are never read.
+
+        """
+        if len(self.ranges) == 1:
+            first, last = self.ranges[0]
+            self.copyfile(source, outputfile, last - first + 1)
+            return
+        for byterange in self.ranges:
+            outputfile.write(self.range_part_header(self.range_ctype, byterange,
+                                                    self.range_size))
+            source.seek(byterange[0])
+            self.copyfile(source, outputfile, byterange[1] - byterange[0] + 1)
+        outputfile.write(self.range_trailer())
  
 
 
+    @instrumented('listing')
     def list_directory(self, path):
         """Helper to produce a directory listing (absent index.html).
 
         Return value is either a file object, or None (indicating an
-        error).  In either case, the headers are sent, making the
-        interface the same as for send_head().
+        error, or that the listing has already been streamed).  In
+        either case, the headers are sent, making the interface the
+        same as for send_head().
+
+        The query string may ask for ?format=json, a page of the listing
+        with ?offset=N&limit=N, and an order with ?sort=name, size or
+        date (prefixed with - for descending).  Listings of more than
+        listing_stream_threshold entries are streamed row by row, with
+        chunked encoding where the client supports it.
+
+        Rendered pages are kept in self.listing_cache, keyed on the
+        directory and validated against its mtime, so showing an
+        unchanged directory again costs a single stat() call.  The same
+        mtime makes up a weak ETag, so revalidating costs no body at all.
 
         """
         try:
-            list = os.listdir(path)
+            st = os.stat(path)
         except os.error:
             self.send_error(404, "No permission to list directory")
             return None
+        query = self.path.split('#', 1)[0].partition('?')[2]
+        try:
+            fmt, offset, limit, sort = self.listing_options(query)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return None
+        urlpath = urllib.parse.unquote(self.path.split('?', 1)[0].split('#', 1)[0])
+        displaypath = html.escape(urlpath)
+        ctype = "application/json" if fmt == 'json' else "text/html"
+        encoding = None
+        if self.compress:
+            encoding = next(iter(accepted_encodings(
+                self.headers.get('Accept-Encoding'), list(COMPRESSORS))), None)
+        # A directory changed within the mtime granularity could look
+        # unchanged later on, so only cache and validate settled listings.
+        settled = time.time() - st.st_mtime > 2
+        etag = last_modified = None
+        if settled:
+            etag = 'W/"%x-%x%s"' % (st.st_ino, st.st_mtime_ns,
+                                    '-' + encoding if encoding else '')
+            last_modified = self.date_time_string(st.st_mtime)
+        cache_control = self.cache_control_for(path) or "no-cache"
+        if settled and self.not_modified(etag, st.st_mtime):
+            self.send_response(304)
+            self.send_cache_headers(etag, last_modified, cache_control, self.compress)
+            self.end_headers()
+            return None
+        key = (path, displaypath, fmt, offset, limit, sort, encoding)
+        page = self.listing_cache.get(key, st.st_mtime_ns)
+        if page is None:
+            try:
+                entries = self.scan_directory(path, sort)
+            except os.error:
+                self.send_error(404, "No permission to list directory")
+                return None
+            total = len(entries)
+            entries = entries[offset:None if limit is None else offset + limit]
+            if fmt == 'json':
+                pieces = self.render_listing_json(entries, urlpath, offset, total)
+            else:
+                nav = self.listing_nav(offset, limit, sort, total)
+                pieces = self.render_listing(entries, displaypath, nav)
+            if len(entries) > self.listing_stream_threshold:
+                self.send_response(200)
+                self.send_header("Content-type", ctype)
+                if encoding is not None:
+                    self.send_header("Content-Encoding", encoding)
+                self.send_cache_headers(etag, last_modified, cache_control, self.compress)
+                self.stream_listing(pieces, key if settled else None,
+                                    st.st_mtime_ns, encoding)
+                return None
+            page = b''.join(pieces)
+            if encoding is not None:
+                compressor = COMPRESSORS[encoding]()
+                page = compressor.compress(page) + compressor.flush()
+            if settled:
+                self.listing_cache.put(key, st.st_mtime_ns, page)
+        f = BytesIO(page)
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(page)))
+        self.send_cache_headers(etag, last_modified, cache_control, self.compress)
+        self.end_headers()
+        return f
+
+    def listing_options(self, query):
+        """Return (format, offset, limit, sort) from a listing query string.
+
+        Raise ValueError if any of them is invalid.
+
+        """
+        params = urllib.parse.parse_qs(query)
+        def param(name, default=None):
+            return params.get(name, [default])[-1]
+        fmt = param('format', 'html')
+        if fmt not in ('html', 'json'):
+            raise ValueError("Unknown listing format")
+        try:
+            offset = int(param('offset', 0))
+            limit = param('limit')
+            limit = None if limit is None else int(limit)
+        except ValueError:
+            raise ValueError("Invalid offset or limit")
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError("Invalid offset or limit")
+        sort = param('sort', 'name')
+        if sort.lstrip('-') not in ('name', 'size', 'date'):
+            raise ValueError("Unknown sort order")
+        return fmt, offset, limit, sort
+
+    def listing_nav(self, offset, limit, sort, total):
+        """Return Previous/Next links for a paginated HTML listing."""
+        if limit is None or limit == 0:
+            return b''
+        links = []
+        if offset > 0:
+            links.append('<a href="?offset=%d&amp;limit=%d&amp;sort=%s">Previous</a>'
+                         % (max(offset - limit, 0), limit, sort))
+        if offset + limit < total:
+            links.append('<a href="?offset=%d&amp;limit=%d&amp;sort=%s">Next</a>'
+                         % (offset + limit, limit, sort))
+        return ('<p>Entries %d-%d of %d %s</p>\n'
+                % (min(offset + 1, total), min(offset + limit, total), total,
+                   ' '.join(links))).encode()
+
+    def stream_listing(self, pieces, key, mtime, encoding=None):
+        """Send the listing PIECES as they are produced.
+
+        The status line and headers other than the framing ones must
+        already have been sent.  Pieces are batched into blocks of about
+        64 KiB and compressed with ENCODING, if given.  If KEY is given
+        and the whole page fits in the listing cache, it is cached too.
+
+        """
+        out = self.start_stream()
+        if self.command == 'HEAD':
+            return
+        compressor = COMPRESSORS[encoding]() if encoding is not None else None
+        page = [] if key is not None else None
+        size = 0
+        batch = []
+        batch_size = 0
+        for piece in pieces:
+            batch.append(piece)
+            batch_size += len(piece)
+            if batch_size >= 64 * 1024:
+                block = b''.join(batch)
+                if compressor is not None:
+                    block = compressor.compress(block)
+                out.write(block)
+                if page is not None:
+                    page.append(block)
+                    size += len(block)
+                    if size > self.listing_cache.max_bytes:
+                        page = None
+                batch = []
+                batch_size = 0
+        block = b''.join(batch)
+        if compressor is not None:
+            block = compressor.compress(block) + compressor.flush()
+        out.write(block)
+        out.close()
+        if page is not None:
+            page.append(block)
+            self.listing_cache.put(key, mtime, b''.join(page))
+
+    def start_stream(self):
+        """End the headers of a response whose length isn't known yet.
+
+        Return a ChunkedWriter for the body.  HTTP/1.1 clients get
+        chunked transfer encoding; older ones get the body delimited by
+        closing the connection.
+
+        """
+        chunked = (self.protocol_version >= "HTTP/1.1"
+                   and self.request_version >= "HTTP/1.1")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        return ChunkedWriter(self.wfile, chunked)
+
+    def scan_directory(self, path, sort='name'):
+        """Return the os.DirEntry objects of PATH in SORT order.
+
+        Names sort case-insensitively; "size" and "date" (creation
+        time) sort on stat() results, and a leading "-" reverses the
+        order.  DirEntry caches its type and stat() result, so each
+        entry costs at most one stat() call however often it is looked
+        at, and sorting by name needs none at all.  Files of uploads
+        still in progress are left out.
+
+        """
+        with os.scandir(path) as it:
+            entries = [entry for entry in it if not upload_temp_name(entry.name)]
+        entries.sort(key=lambda entry: entry.name.lower())
+        field = {'size': 'st_size', 'date': 'st_ctime'}.get(sort.lstrip('-'))
+        if field is not None:
+            entries.sort(key=lambda entry: getattr(entry_stat(entry), field, 0))
+        if sort.startswith('-'):
+            entries.reverse()
+        return entries
+
+    def render_listing(self, entries, displaypath, nav=b''):
+        """Yield the HTML listing page for ENTRIES in pieces.
+
+        The head of the page comes first and then one table row per
+        entry, so a streamed page shows up before every entry has been
+        stat()ed.  NAV is inserted below the table.
+
+        """
         enc = sys.getfilesystemencoding()
-        list.sort(key=lambda a: a.lower())
         f = BytesIO()
-        displaypath = html.escape(urllib.parse.unquote(self.path))
         f.write(b'<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
         f.write(b'<html>\n')
         f.write(('<meta http-equiv="Content-Type" '
@@ -235,31 +2612,41 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         f.write(b'th, td {\n  padding:0px 10px;\n}\n')
         f.write(b'</style>\n')
         f.write(("<body>\n<h2>Directory listing for %s</h2>\n" % displaypath).encode(enc))
+        f.write(b'Download this directory as <a href="?archive=zip">ZIP</a>, ')
+        f.write(b'<a href="?archive=zip-deflate">compressed ZIP</a> or ')
+        f.write(b'<a href="?archive=tar">TAR</a>\n')
         f.write(b"<hr>\n")
-        f.write(b"<form ENCTYPE=\"multipart/form-data\" method=\"post\">")
+        f.write(b"<form id=\"upload\" ENCTYPE=\"multipart/form-data\" method=\"post\">")
         f.write(b"<input name=\"file\" type=\"file\" multiple/>")
-        f.write(b"<input type=\"submit\" value=\"upload\"/></form>\n")
+        f.write(b"<input type=\"submit\" value=\"upload\"/>")
+        f.write(b" <span id=\"upload-status\"></span></form>\n")
+        f.write(UPLOAD_SCRIPT)
         f.write(b"<hr>\n")
         f.write(b'<table>\n')
         f.write(b'<tr><td><img src="data:image/gif;base64,R0lGODlhGAAYAMIAAP///7+/v7u7u1ZWVTc3NwAAAAAAAAAAACH+RFRoaXMgaWNvbiBpcyBpbiB0aGUgcHVibGljIGRvbWFpbi4gMTk5NSBLZXZpbiBIdWdoZXMsIGtldmluaEBlaXQuY29tACH5BAEAAAEALAAAAAAYABgAAANKGLrc/jBKNgIhM4rLcaZWd33KJnJkdaKZuXqTugYFeSpFTVpLnj86oM/n+DWGyCAuyUQymlDiMtrsUavP6xCizUB3NCW4Ny6bJwkAOw==" alt="[PARENTDIR]" width="24" height="24"></td><td><a href="../" >Parent Directory</a></td></tr>\n')
-        for name in list:
+        yield f.getvalue()
+        for entry in entries:
+            name = entry.name
             dirimage = 'data:image/gif;base64,R0lGODlhGAAYAMIAAP///7+/v7u7u1ZWVTc3NwAAAAAAAAAAACH+RFRoaXMgaWNvbiBpcyBpbiB0aGUgcHVibGljIGRvbWFpbi4gMTk5NSBLZXZpbiBIdWdoZXMsIGtldmluaEBlaXQuY29tACH5BAEAAAEALAAAAAAYABgAAANdGLrc/jAuQaulQwYBuv9cFnFfSYoPWXoq2qgrALsTYN+4QOg6veFAG2FIdMCCNgvBiAxWlq8mUseUBqGMoxWArW1xXYXWGv59b+WxNH1GV9vsNvd9jsMhxLw+70gAADs='
-            fullname = os.path.join(path, name)
             displayname = linkname = name
-            fsize = fbytes(os.path.getsize(fullname))
-            created_date = time.ctime(os.path.getctime(fullname))
+            fsize = created_date = ''
             # Append / for directories or @ for symbolic links
-            if os.path.isdir(fullname):
+            if entry.is_dir():
                 dirimage = 'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAGQAAABkCAYAAABw4pVUAAAABmJLR0QA/wD/AP+gvaeTAAAFlUlEQVR4nO3dfUxVZRwH8O9z30AmBF6ncUEul8gmV0ylzLes1h+9OedqUVvMps2XBbVsc7U1ajOrlZvTrdocWzS3spVlI2C6stxCVnOo1b3TrhiHlwkIAsIFr/ft6Y9b6BWZ57n3nMMD/D7/MA7nPOe3++P3POd5DpwDEEIIIYQQQgghhBBCCCFEYyzZBgoLC1M4T50TCjGrFgHdjtXKQ4wFLjU3N18z4nxGSygheXnFWcwc3Q6gFMA92oakDgfOg7NDYVtwz0Wfr3ciYtCDcEKcTvcjMOFrALMBwGazwD4rDVarWfPgbiUS4bjc50cgEP5/0wAYK2v9x1NnSAA6E0rIPFfRgyawnwDYVq8owCvb1uC+pXkwmZLu+YRwzuE924Wq6kbU1HsAIMI41iqK94ihgehA9SfpcJSkWVMDPnDkbCxbhso3HwdjxibiVg4cPIl3dtUDQC/j1rsV5czARMeUDNX9TJbd/jIDShcvysUne541vCrGc29xDtra+3DOdymNmSKDA/09DRMdUzIsqvdkeBoAtmxaOSYZ53zd+LSqAY2/teBy37AmgTnnZeH4kVcBABWvH8LJU21YvcKF8i1rUOCyx+27eeMqHP7hL0Q5Ww/gA00CmCCqf82dLncPgNlNDTswKyttdHvdUS/e3lmPbZtXYe0TC5E9N0OPONHZPYiaOg+qqhvx4a51ePSh+XE/X1DyHg8EwldaW7xZugRgEPUVAtgBICtzxuiG5gu9qNxZjwNVZVhYlK11bHGy52Zg66aVWLnchY1bv8B3X76EvHnXP/s7MmawQGAoU9cgDGAS2JcBiBvI91efwKYNy3VPxo2Ki7Lx4gvLsP+zRsPOaSSRhPCbNzQ0XsC6JxdqGI46654qxvFfz8dtS02JFbvDUZJ2q2MmC5Eui+OmMaen148ch/G9RK4jE6mp8aEvKs5Ba3s/rCmBj3ILFuwzhS0RI2Ixm/lwS4unW6v2RBIyRiTCYTYbf/lrNjMcq62I27a94mEc++VvPnI1VG7mpnKYo4bEEgXgdLk7GEelong/T7a9pBIiE5fTjtpvt7K9Hx+H52wnwmFjEhIKRdDZNZjLGarz890BRfF+lUx7ol2W1FxOO/btfsbw854604HSDdU8Eom+ASCphIgM6mQcSxfnovCu2QCQ9BVOUglx5dtvv9M0YbOYGTQYAoQvezm/3nP9XFcx7s4kMdRlSSaBCtEpEgKAKkQ6wpe9Uc5h+m/Cvv65KvzhuahHXJOW0+W+uQ/5vbXFu1zt8cIVwm5YPaFkqPKAyM7Cl2l87JIWfCeWiDYzLcxfdVr4mKRWe4n2xAd1SouukpoYEu0Zstpb8pgHQ/6Qbu2nz7Si6ajxN8r0IHzZm0iFDPlDeK1yt/Bxau19d4dubRuNJoaSoaUTyVCFSIYqRDJUIZKheYhkqEIkQ2OIZAyZqafPtOo6ectIN+T/TQ0hPlNPYHVxqixrGCGB1V7qs/RE90MkI1whVCD6ogqRjHiF6BEFGUUTQ8nQ0olkqEIkQ0snkqEKkQyNIZKhCpEMVYhkaGIoGVo6kQz9sbVkqEIkk8DyO+VFT1QhkqEbVJKhCpEMjSGSSXimHo3Gvsry/N6pIuG1rGAw9gQ9ywQ8UW4qE0lIEMDoQ/BD4VhCrFPmmXRyEEnICAAM+QMAgGAwlhiLhSpESwIJYVcAoH/gKgDAPxwEAKSnG/OaiulCdUIYuA8Amk63AwBalNg7VBx32vSIa9JTOkZfANQncpzqhETBfgSAbw6fQWfXIGqPeAEAS9wzRc43LSgd1/DW+22xbziOihyregBwu902/wj+xAS94mhSYryXRaP3K8o5Re0hqgeAnp6eiH3WnBrOkA8gDwD1VePrB8f3jEefF0kGIYQQQgghhBBCCCGEEEJ08S96MLERXBz0BQAAAABJRU5ErkJggg=='
                 displayname = name + "/"
                 linkname = name + "/"
-                fsize = ''
-                created_date = ''
-            if os.path.islink(fullname):
+            else:
+                st = entry_stat(entry)
+                if st is not None:
+                    fsize = fbytes(st.st_size)
+                    created_date = time.ctime(st.st_ctime)
+            if entry.is_symlink():
                 dirimage = 'data:image/gif;base64,R0lGODlhGAAYAPf/AJaWlpqampubm5ycnJ2dnZ6enp+fn6CgoKGhoaKioqOjo6SkpKWlpaampqioqKmpqaqqqqurq6ysrK2tra6urq+vr7CwsLGxsbKysrOzs7S0tLW1tba2tre3t7i4uLm5ubq6uru7u7y8vL29vb6+vr+/v8LCwsPDw8bGxtDQ0NTU1NXV1dbW1tfX19jY2Nra2tzc3N3d3eDg4OHh4eLi4uPj4+Tk5OXl5efn5+np6erq6uvr6+zs7O7u7u/v7/Dw8PHx8fLy8vPz8/T09PX19fb29vf39/j4+Pr6+vv7+/39/f7+/v///wAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAACwAAAAAGAAYAAAI/wCZCBxIsKDBgwgLrsigwUXChEVGYNBwIYKIJA8LFunwocKGDA8ieMg4kAiHDxRmCGyhIAEKkhtR2iCYYYEAkiNQ3ijYIQGAjDkuVFBJsIcBAhcyttCgoSCQBQcUFMn44gIFEiwE/oAqIAfJIREeQLDAZIeCAwO8IuQRowYSIxQgBFhAoQBatQaFiLCQoQIFCxEMREUwoAEPhEA0dMQwQSwCIEFYpKCR8IfiCjWYgJCr4AhJyx13CFRhQYECGBmRcKwgmmAEBCsyltBQQUfBGwUG4MjoYMOIgjsSIJBAskGGEAR3IEhw4AdJExIeyBCIY/kBHySZLNEwgcGGDQYQNBbPLpAIBgULEhB4AIQ8wRMFBIhQ4j4gADs='
                 displayname = name + "@"
             if name.endswith(('.bmp','.gif','.jpg','.png')):
-                dirimage = name
+                dirimage = urllib.parse.quote(name)
+                if self.thumbnails is not None:
+                    dirimage += '?thumbnail'
             if name.endswith(('.avi','.mpg')):
                 dirimage = 'data:image/gif;base64,R0lGODlhGAAYAMIAAP///7+/v7u7u1ZWVTc3NwAAAAAAAAAAACH+RFRoaXMgaWNvbiBpcyBpbiB0aGUgcHVibGljIGRvbWFpbi4gMTk5NSBLZXZpbiBIdWdoZXMsIGtldmluaEBlaXQuY29tACH5BAEAAAEALAAAAAAYABgAAANvGLrc/jAuQqu99BEh8OXE4GzdYJ4mQIZjNXAwp7oj+MbyKjY6ntstyg03E9ZKPoEKyLMll6UgAUCtVi07xspTYWptqBOUxXM9scfQ2Ttx+sbZifmNbiLpbEUPHy1TrIB1Xx1cFHkBW4VODmGNjQ4JADs='
             if name.endswith(('.idx','.srt','.sub')):
@@ -267,16 +2654,30 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             if name.endswith('.iso'):
                 dirimage = 'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAADAAAAAwCAYAAABXAvmHAAAABmJLR0QA/wD/AP+gvaeTAAANQUlEQVRoge2ZW4ykR3XHf6eqvkt3z2VnvevFu8viGG+IbO86IVFi5QGIEFYMtsRLXkiIDBaKFRyIoigoIkFLFMNDFCFbYIhsQxQlQYmyWNgh+MEoUpBtxXkADDZmbWMb33b2Ppfu71ZVJw/V0zOzMzuzdnB44Uit7v6+qv7O//zPOfWvavi5/WxNfho/Mv/Q7XsWG/0swo0x+n70ZF7bvAsBHzt89IAgKM5azSV7aW6mf92B64+88n999usGoHrEPPPN7N+Lnb3fRqN0TUOoK9phS6g9dVfThobaN7Sxm8yzYumXA6YHcxQu74wr7nrbjeFPRI7E/zcAzz50+7FsujxoMsAoGiPdqMUPW/wovWrfUIeGuqvoop/MzU1G7nIKm1O4giwryPuDF401/3Dle//yL95QAM8+ePv7VPR+m4sxfYstXLqhSqg87bDBj2q65ZYmtNRdReXrCQABcltQuiKBMDkiyQXjHFl/8JTD3fbWmz75rYv1yVzswGP3HznaVKMH2mrZdF1L7AIaNd0UAScYazBiERFEFBB0TYxEBGtMesdMnAeI3tMsLvxS21UPHPuPv/6bi/VrWwZUj5hjR/3pbnm4I1owuSPrF9hBRjYosbkFAQ2RdqmhGzZ0yzVN01J1Q6pQ04XEgDWW0paUWUHPFIjZPH7GZWT96W/+4o3+xu1qY0sGVI+YH/1T07UvntkRl2toAtF7QtcR24hvPKqJBTEG4wxiBMFgJMVnLQPGCM4YnLgLOg8QfUe7vHDDM9+Q/1Q9sqWPW9586svDrn1+3sRhjVYBWg9tJLSe0LTEriO2AVK2IM5grCBW0jUDrAAEnDiscVjZvvQ0Bpql5Xc8/XW+97oA/PDv//QFf/ys0aqDxkPj0aqD2qNNINQerbv0Pq4FcTa9LGCEVAYrAAwGgzUWI25bAIhgcgfOXnPsgU8/9JoAHDv6qffFs/WBOGrShagJRBXQ2kPliV2gqzyh7Yhth6pijIxZsAjjAhvX+Ur6WCzbESBGcL0+Wb+PK3tkUzPvfvrrf/XhzcZuGoowbB7wy0OwBkJcD8JI8swoasA3FptZTJHy2lmDN4IRAxh07KwVhxGHtVs3PmMttuzhyh6uLHF5iSkKXJbfA3x5w/jzL/zo6Kfu9KORSC+HXgaFWe1VUaHu0FEHdSDWgTD0+LojVD6le5YhzjKZFJOIcMbgTIbZouxMluEGU+SDKbL+gKw/RTbok/f79HZfKj/59p1ntwSgesSE6G9RKzDlkIGFXg5lBm7sUNBUB6MOhi2x6fDDjlC3aIwYB2LHPV4EFUUQrGRk9kK5L9iiIO9PkQ+myfvTFNPT5FMDssEMWX+aYmYHvZ17dpzfldb94tNH45+Hru3TdxAsZIJkEXKLNgbqAF1IIEYdSuo4wRm6ymCKDAmCLrTkneESZtiZT+M1EEUxatFxUa/xHdcrycsp3KCPK/tkZQ9blNiywOYlLs8Q6+jt2sWJx69cBvqbAgiE96uOc94K2ByyCFlAMkEzA7VJteAjDNuU41YIojSnW7QJG+LrVjztImqFkIMaQAxFf4CbniLvDbDjwrV5iSsLXF4i1k5+xxYFNst65+FP9uTR2y+jW3zBhy7blOUQofNQR7Tyk9aKgMyUuH4JCq43zdyhdzD1lqvJZ3cD0C6cYPmFJzj7/W/jqyUQIU5lZDtmyKdmUqr0B7hyQFb2EpPOIZsIhfrECU6cevo33vabn3hsHQM2jD7SxrC585A6ks0hVyQ3aG1g5JC2w1qLtp6Zg29n77t/F5OX66aWu/ZT7trPzkPv5JWH/pHFZ76DORfI9+6ld8lOXG9A1hvgyjKtIxdQOApks7NMnZn7FjANa4o4qv76JH22MiPQz5HZHjJXIFMZMQSmr7iW/Td8eIPz66bmJfvfewtTVxwmtC3ti8fpz+2iv2Mn+WCAOT/qqmiISb40Lb6uiF2HhjhYGeJWx8a923u/xqyAFbQNuP40e9/zwbFqUEIInDt3jrquASjLktnZWZxLj9v3ng8yfP4pmvnTdAtDsumZVYejojGgPhCjJ8aIhoDGiGqEGCGu1tkqgBgve00AAKoOVJn7ld9CbUYIgRACp0+dgqX5k7p4/OMA7cyb7jjZ7Nl9ya5dWGvB5sz98rs4+fD9LD3zLMWllxC8B+8JwUMMxKgQxgA0JrkSI6qKb9sJTRMAglwqxkyiuBKRLa1OW8XB5dcQY0q/hYUFWJw/ue+qX710zcivvvSDx4aLed6fnZ0FoH/5NfDw/YxefoXR6XnUKzH6iZOqAQ2afFGFqCgJRGibjQwY54zk+QqYiUxOF8abkxVlqYoq+LiQvg/m8D5p/qZp4OQrf3Q+1vbsqzfr7GX/ujLOTu8EIIxGjOZPgOhYFEY0jp8hmtYa1bEsV1AIbbsJgDzHDvrjxppOEFTSu6ikzwYgaX5UWPrxPIrifYfI6gLZ2bDavFfMxwKg6xJrOnZCFarTJ9KmSMYlLGNnkUkyrF4DaVebzWobzXKyQQ8wGEkiTCTpICMGHcsDEYOxDrGGUa+HXx5SnzmO25l6gLUWnd5zN/DPa/23u/Z9zhgzAdCdmR/fgK6uNuBdZxP5KoiAiTKp4lUGspysPzPRMMYIGIOITdrGGLAOay3GWEzm6O/fy+JTTzN6/kn6MynljTGYnfv6z33v0RNx8eTHAczM7jvM7Jt2GWMmqVY9/4P04OLCS8/EJumcUpdo5jcAcJnTrD8QMYIYCzYxIcZijEkro02fVyIy/dYrEoAnH8Fd+Wvg8tWIz+3bbef2TViIqrQradM1VD98NN3oXcTmZgOgeHwDAMWQ9wdjx1eiblO+n78DUUVDIJubId+1k/bUGZYfuY/8uvez/TmB0jz6NWIzAmch21gu2wPgpQ0AxJiRWDuwvd4FXVAU9YFQN7T1Mn40pPiFvXRnFwgvP0X9yNcw114PWbH5/K4hfvdBOP5MaihekXNNYqFIrF+E82jkkQ0A8l59fXPy9MODA/s3mwM+4NuGUFW0zZAwHNEMh7SjZdg9BScW0VePEU6/SDxwGN19OdrbkYJTnUNOPIf5yePQpdVZQ0z77C4irU97jtJBbrYEYrw2dTu8d+X7umDP/89XdObgwfXOh4Bva3zdENqabjQiVCPaaohfWqYZDUEj+ABnqqRQtzAZ5Ggvh6UaXWyhDcnhMkN6Fi0ckhvIXZIr5wOow39fc8sd121gACD4rvLDUc8N+mjw+LYjtg2+bfB1ja9H+FFFVw/phiNCPVrtEM7CpVPQePxyAmJjipHJHdklA/K9s0RraU4vEaJCFFiqoYswalBvEyulQ3KFXNYDiQoh3rcuIOuirZj5x74SBm95M6FtCW1DaCtCMz7zbCp8M6IbDolNw2ZCI2hg2I1YbpZRhB3FDDtmZyl2zZBN52gbqM6M6BZGxHMVutTBcpsYhMRGbmCFicKBS4yYNpy6+pY794gwWcnWMSBCfO4bJ87aqXIOawltTaxruqbB1xVdXeGrEbHr2NQUutjhQ0dUZeXwLQRFg4eYYzKL62fEriD6gESShBhp2uWFCI1C0MRIBxQGCQpi71vr/AYGVuzH9382lvv2SGiacf7X+KYiVDUxXDjHo0YqP2LYVjShxRrLTD7FdG+acuc0+VyJzRyhDbQLFe1STVio0eUWhi2MutVjnBU2MguFRcosHv7YXRt67qarSH3mxEdi9PfYqR5dW+ObhlCPVk+jL2AhBHyIhLjqhIqgIWn82EZsBsZZbGnJ2ozYj6ARJY6FkV8FEdI1sSB59oHNnrlpv7rq5s/d25w99WBz7hzdaEioqm2dV4WOQNBAGLNskLToEVG/xiEDtsiQ0pH1HFJkSGGRXpZyfk0bFRHMVP7ioVvv+peLBgBw9YfuuKE9dfaJOKq5mK1mJBCiJ0SfdDukIxRJ+kU1EEMkjqNrnMUVDlM4TOmQMk+LWc+tgjCCDLJ4zce+dOBCz91y6Tv0B184rEvVfxG22dig+BCIGggaV0+k1YAKSlq4NCStD+n80+TpWNKWGVJm0M+QnksLWmFhOtNDn7hnS62xJQAR4qE//NK7WGz+DX9hFoJGfAyEGIlrm4SM5UdceUXUh8nSYTKb9iG5xfYMUtjUPjMDg8xf+2f3bqstth0ggh6+7a7fkaXmM9TdcLMxPgYinqBx3U5OWDlij2mPq5pSaIUhEWyRpLnNHDbPEKKS2+9c+8d/dxE6+zX8R3boti9+0vhwE4vVk2tbXdRIjKnzRA2r204Y7+pSDUiMxKDgFV3DptgEgghxsVIX9fcO3/r5t1+sX6/rb9bHP//RT+P4EP38zZ14Wt9QxY7O1/hxCxUgdwWFK+nZgiLPyaYK3KDA9XJsmc6AYt1Rv7qIr9qXr/rA325Ukm8EAEiy4/t3f/TuEPX3W21dZTuq2BDXMJD+Dy7ouZLCjQH0C4y1aNVCUILG5YM3fWb2/BX2DQew1r77xVv3dcSH21gf8CFODtecOJx15JJhrYs2tyLWqsnsWVsN33nw5i888dN4/s/tZ2n/C+cR4IqwA3arAAAAAElFTkSuQmCC'
                 # Note: a link to a directory displays with @ and links with /
-            f.write(('<tr><td><img src="%s" width="24" height="24"></td><td><a href="%s">%s</a></td><td style="text-align:right; font-weight: bold; color:#FF0000">%s</td><td style="text-align:right; font-weight: bold;">%s</td></tr>\n'
-                    % ( dirimage, urllib.parse.quote(linkname), html.escape(displayname) , fsize , created_date )).encode(enc))
-        f.write(b"</table><hr>\n</body>\n</html>\n")
-        length = f.tell()
-        f.seek(0)
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
-        self.send_header("Content-Length", str(length))
-        self.end_headers()
-        return f
+            yield ('<tr><td><img src="%s" width="24" height="24"></td><td><a href="%s">%s</a></td><td style="text-align:right; font-weight: bold; color:#FF0000">%s</td><td style="text-align:right; font-weight: bold;">%s</td></tr>\n'
+                    % ( dirimage, urllib.parse.quote(linkname), html.escape(displayname) , fsize , created_date )).encode(enc)
+        yield b"</table>" + nav + b"<hr>\n</body>\n</html>\n"
+
+    def render_listing_json(self, entries, urlpath, offset, total):
+        """Yield the JSON listing for ENTRIES in pieces, one per entry."""
+        yield ('{"path": %s, "offset": %d, "total": %d, "entries": ['
+               % (json.dumps(urlpath), offset, total)).encode()
+        sep = '\n'
+        for entry in entries:
+            is_dir = entry.is_dir()
+            st = entry_stat(entry)
+            item = {
+                'name': entry.name,
+                'type': 'dir' if is_dir else 'file',
+                'link': entry.is_symlink(),
+                'size': None if is_dir or st is None else st.st_size,
+                'mtime': None if st is None else st.st_mtime,
+                'ctime': None if st is None else st.st_ctime,
+                'url': urllib.parse.quote(entry.name + ('/' if is_dir else '')),
+            }
+            yield (sep + json.dumps(item)).encode()
+            sep = ',\n'
+        yield b'\n]}\n'
 
     def translate_path(self, path):
         """Translate a /-separated PATH to the local filename syntax.
@@ -300,7 +2701,8 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             path = os.path.join(path, word)
         return path
  
-    def copyfile(self, source, outputfile):
+    @instrumented('download')
+    def copyfile(self, source, outputfile, count=None):
         """Copy all data between two file objects.
 
         The SOURCE argument is a file object open for reading
@@ -313,9 +2715,136 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         -- note however that this the default server uses this
         to copy binary data as well.
 
+        If COUNT is given, only that many bytes are copied from the
+        current position of SOURCE.  Return the number of bytes copied.
+
+        Regular files going straight to a plain TCP socket are sent
+        with sendfile(), so the data never passes through Python.
+        Everything else (in-memory pages, TLS-wrapped sockets) falls
+        back to a large-buffer readinto() loop.
+
         """
-        shutil.copyfileobj(source, outputfile)
- 
+        if outputfile is self.wfile and self.can_sendfile(source):
+            if self.wfile.throttle is None:
+                sent = self.connection.sendfile(source, source.tell(), count)
+                self.wfile.add(sent)
+                return sent
+            # Rate limited: hand the kernel a piece at a time.
+            sent = 0
+            while count is None or sent < count:
+                n = self.wfile.chunk if count is None else min(self.wfile.chunk, count - sent)
+                n = self.connection.sendfile(source, source.tell(), n)
+                if not n:
+                    break
+                self.wfile.add(n)
+                sent += n
+            return sent
+        readinto = getattr(source, 'readinto', None)
+        buf = bytearray(self.copy_bufsize)
+        view = memoryview(buf)
+        copied = 0
+        while count is None or count > 0:
+            if count is not None and count < len(buf):
+                view = view[:count]
+            if readinto is not None:
+                n = readinto(view)
+            else:
+                data = source.read(len(view))
+                n = len(data)
+                view[:n] = data
+            if not n:
+                break
+            outputfile.write(view[:n])
+            copied += n
+            if count is not None:
+                count -= n
+        return copied
+
+    def can_sendfile(self, source):
+        """Return True if SOURCE can be sent to the client with sendfile()."""
+        if not self.use_sendfile or type(self.connection) is not socket.socket:
+            return False
+        try:
+            return stat.S_ISREG(os.fstat(source.fileno()).st_mode)
+        except (AttributeError, OSError, ValueError):
+            return False
+
+    def measure(self, kind, method, args, kwargs):
+        """Call METHOD, recording the call as KIND; see instrumented()."""
+        metrics = self.metrics
+        start = time.perf_counter()
+        received = self.rfile.count
+        if kind == 'request':
+            self.status = None
+            if metrics is not None:
+                metrics.add('http_requests_in_flight')
+        result = None
+        try:
+            result = method(self, *args, **kwargs)
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            if kind == 'request':
+                self.request_finished(elapsed)
+            elif metrics is None:
+                pass
+            elif kind == 'listing':
+                metrics.listing_finished(elapsed)
+            elif kind == 'download':
+                if result is not None:
+                    metrics.transfer_finished('download', result, elapsed)
+            elif kind == 'upload':
+                metrics.transfer_finished('upload', self.rfile.count - received,
+                                          elapsed)
+
+    def request_finished(self, elapsed):
+        """Record a request that took ELAPSED seconds to answer.
+
+        The bytes counted since the previous request on the connection
+        finished include the request line and headers of this one.
+
+        """
+        sent = self.wfile.count - self.sent_mark
+        received = self.rfile.count - self.received_mark
+        self.sent_mark = self.wfile.count
+        self.received_mark = self.rfile.count
+        if self.metrics is not None:
+            self.metrics.request_finished(self.command, self.status, elapsed,
+                                          sent, received)
+        if self.log_format == 'json':
+            self.write_log({
+                'remote': self.client_address[0],
+                'method': self.command,
+                'path': self.path,
+                'protocol': self.request_version,
+                'status': self.status,
+                'duration_ms': round(elapsed * 1000, 3),
+                'bytes_sent': sent,
+                'bytes_received': received,
+                'referer': self.headers.get('Referer'),
+                'user_agent': self.headers.get('User-Agent'),
+                })
+
+    def log_request(self, code='-', size='-'):
+        """Remember the status; in JSON mode request_finished() logs it."""
+        if code != '-':
+            self.status = int(code)
+        if self.log_format != 'json':
+            http.server.BaseHTTPRequestHandler.log_request(self, code, size)
+
+    def log_message(self, format, *args):
+        if self.log_format != 'json':
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+            return
+        self.write_log({'remote': self.client_address[0],
+                        'message': format % args})
+
+    def write_log(self, record):
+        """Write RECORD to stderr as one line of JSON, with a timestamp."""
+        record = dict(time=datetime.datetime.now(datetime.timezone.utc)
+                      .isoformat(timespec='milliseconds'), **record)
+        sys.stderr.write(json.dumps(record) + '\n')
+
     def guess_type(self, path):
         """Guess the type of a file.
 
@@ -350,6 +2879,333 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         '.h': 'text/plain',
         })
  
+
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+
+    """TCP server handing connections to a bounded pool of worker threads.
+
+    At most MAX_WORKERS connections are served at once and up to
+    QUEUE_SIZE more wait for a free worker.  Connections arriving while
+    the queue is full get a short 503 reply instead of piling up.  The
+    listen() BACKLOG bounds how many connections the kernel holds
+    before they are accepted.
+
+    A handler whose transfer grows into a bulk one calls enter_bulk(),
+    which hands its worker over to the next connection and waits for
+    one of BULK_WORKERS places kept for bulk transfers instead, so that
+    slow downloads and uploads never take all the workers from small
+    requests.  leave_bulk() goes back to the ordinary workers.  Every
+    connection let in has a thread of its own to wait on.
+
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 max_workers=16, queue_size=64, backlog=128,
+                 bulk_workers=None, bind_and_activate=True):
+        self.request_queue_size = backlog
+        self._slots = threading.BoundedSemaphore(max_workers + queue_size)
+        self._workers = threading.BoundedSemaphore(max_workers)
+        self._bulk = threading.BoundedSemaphore(bulk_workers or max_workers)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers + queue_size,
+                                        thread_name_prefix='http-worker')
+        socketserver.TCPServer.__init__(self, server_address,
+                                        RequestHandlerClass,
+                                        bind_and_activate)
+
+    def process_request(self, request, client_address):
+        """Queue the connection for a worker, or reject it if full or
+        if the client already has as many connections as its handler's
+        shaper allows."""
+        shaper = getattr(self.RequestHandlerClass, 'shaper', None)
+        if shaper is not None and not shaper.connect(shaper.client(client_address[0])):
+            self.reject_request(request, b"429 Too Many Requests")
+            self.shutdown_request(request)
+            return
+        if not self._slots.acquire(blocking=False):
+            if shaper is not None:
+                shaper.disconnect(shaper.client(client_address[0]))
+            self.reject_request(request)
+            self.shutdown_request(request)
+            return
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        """Serve one connection on a worker thread."""
+        self._workers.acquire()
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self._workers.release()
+            self.shutdown_request(request)
+            self._slots.release()
+            shaper = getattr(self.RequestHandlerClass, 'shaper', None)
+            if shaper is not None:
+                shaper.disconnect(shaper.client(client_address[0]))
+
+    def enter_bulk(self):
+        """Trade the calling thread's worker for a bulk transfer place."""
+        self._workers.release()
+        self._bulk.acquire()
+
+    def leave_bulk(self):
+        """Trade a bulk transfer place back for a worker."""
+        self._bulk.release()
+        self._workers.acquire()
+
+    def reject_request(self, request, status=b"503 Service Unavailable"):
+        """Tell the client to come back later; never blocks the accept loop."""
+        metrics = getattr(self.RequestHandlerClass, 'metrics', None)
+        if metrics is not None:
+            metrics.add('http_rejected_connections_total')
+        try:
+            request.setblocking(False)
+            request.send(b"HTTP/1.1 " + status + b"\r\n"
+                         b"Retry-After: 1\r\n"
+                         b"Content-Length: 0\r\n"
+                         b"Connection: close\r\n\r\n")
+        except OSError:
+            pass
+
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        self._pool.shutdown(wait=True)
+
+def make_server(address, handler, threads=0, queue_size=64, backlog=128,
+                reuse_port=False, bulk_threads=None):
+    """Bind and listen on ADDRESS.
+
+    With THREADS, connections are served by a ThreadPoolHTTPServer,
+    with up to BULK_THREADS more busy with bulk transfers, otherwise one
+    at a time.  REUSE_PORT sets SO_REUSEPORT so that
+    several processes can each listen on the same address and have the
+    kernel spread the connections between them.
+
+    """
+    if threads > 0:
+        httpd = ThreadPoolHTTPServer(address, handler,
+                                     max_workers=threads,
+                                     queue_size=queue_size,
+                                     backlog=backlog,
+                                     bulk_workers=bulk_threads,
+                                     bind_and_activate=False)
+    else:
+        httpd = socketserver.TCPServer(address, handler,
+                                       bind_and_activate=False)
+        httpd.request_queue_size = backlog
+    try:
+        if reuse_port:
+            httpd.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        httpd.server_bind()
+        httpd.server_activate()
+    except:
+        httpd.server_close()
+        raise
+    return httpd
+
+def reuse_port_supported():
+    """Return True if this system lets sockets share a port."""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        return False
+    try:
+        with socket.socket() as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    except OSError:
+        return False
+    return True
+
+def serve_until_stopped(httpd, stop_signals=(signal.SIGTERM,)):
+    """Serve HTTPD until one of STOP_SIGNALS arrives.
+
+    The server stops accepting and closes once the requests in progress
+    are finished.  shutdown() waits for serve_forever() to return, so it
+    can't be called from the signal handler, which runs on the same
+    thread.
+
+    """
+    def stop(signum, frame):
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+    for signum in stop_signals:
+        signal.signal(signum, stop)
+    with httpd:
+        httpd.serve_forever()
+
+class Supervisor:
+
+    """Keep WORKERS forked processes running SERVE(SLOT).
+
+    SERVE() is called in each child and returns when the worker should
+    exit; it is expected to stop gracefully on SIGTERM.  SLOT is a
+    number below slot_count(WORKERS) that no other running worker has,
+    for keeping per-worker state such as Metrics.  A worker that
+    dies is replaced, after a delay that grows while workers keep dying
+    straight after starting, so that a broken setup doesn't fork in a
+    tight loop.
+
+    SIGTERM and SIGINT stop the workers and return from run() once they
+    have exited, killing any that take longer than GRACE seconds to
+    finish their requests.  SIGHUP replaces every worker with a fresh
+    one, starting the new workers before stopping the old ones so that
+    no connections are refused meanwhile.
+
+    """
+
+    poll_interval = 0.2
+    min_uptime = 1.0
+    max_delay = 30.0
+
+    @staticmethod
+    def slot_count(workers):
+        """Slots needed by WORKERS workers: the running ones, plus two
+        generations of old ones still finishing their requests."""
+        return 3 * workers
+
+    def __init__(self, workers, serve, grace=60.0):
+        self.workers = workers
+        self.serve = serve
+        self.grace = grace
+        self.children = {}   # pid -> start time
+        self.retiring = {}   # pid -> deadline for old workers being stopped
+        self.slots = {}      # pid -> slot, for both of the above
+        self.restarts = []   # times at which to start a replacement
+        self.failures = 0
+        self.request = None
+
+    def run(self):
+        for signum, request in ((signal.SIGTERM, 'stop'),
+                                (signal.SIGINT, 'stop'),
+                                (signal.SIGHUP, 'reload')):
+            signal.signal(signum, self.on_signal(request))
+        for _ in range(self.workers):
+            self.spawn()
+        while True:
+            self.reap()
+            request, self.request = self.request, None
+            if request == 'stop':
+                break
+            if request == 'reload':
+                self.reload()
+            now = time.monotonic()
+            for pid, deadline in list(self.retiring.items()):
+                if now > deadline:
+                    self.kill(pid, signal.SIGKILL)
+            while self.restarts and self.restarts[0] <= now:
+                self.restarts.pop(0)
+                self.spawn()
+            time.sleep(self.poll_interval)
+        self.stop()
+
+    def on_signal(self, request):
+        def handler(signum, frame):
+            self.request = request
+        return handler
+
+    def spawn(self):
+        free = set(range(self.slot_count(self.workers))) - set(self.slots.values())
+        if not free:
+            # Reloaded yet again while old workers are still finishing:
+            # cut the oldest of them short rather than share its slot.
+            pid = min(self.retiring, key=self.retiring.get)
+            self.kill(pid, signal.SIGKILL)
+            free = {self.slots.pop(pid)}
+        slot = min(free)
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                # Ctrl-C reaches the whole process group: let the
+                # supervisor decide what happens.
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self.serve(slot)
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+        self.slots[pid] = slot
+
+    def reap(self):
+        """Collect exited workers and schedule replacements."""
+        while self.children or self.retiring:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                self.retiring.clear()
+                self.slots.clear()
+                return
+            if pid == 0:
+                return
+            self.slots.pop(pid, None)
+            if self.retiring.pop(pid, None) is not None:
+                continue
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+            now = time.monotonic()
+            if now - started < self.min_uptime:
+                self.failures += 1
+            else:
+                self.failures = 0
+            delay = min(self.max_delay, 2 ** self.failures - 1)
+            if os.WIFSIGNALED(status):
+                how = "was killed by signal %d" % os.WTERMSIG(status)
+            else:
+                how = "exited with status %d" % os.WEXITSTATUS(status)
+            sys.stderr.write("worker %d %s, restarting%s\n"
+                             % (pid, how, " in %ds" % delay if delay else ""))
+            self.restarts.append(now + delay)
+            self.restarts.sort()
+
+    def reload(self):
+        old = list(self.children)
+        self.children.clear()
+        self.restarts = []
+        self.failures = 0
+        deadline = time.monotonic() + self.grace
+        for pid in old:
+            self.retiring[pid] = deadline
+        for _ in range(self.workers):
+            self.spawn()
+        for pid in old:
+            self.kill(pid, signal.SIGTERM)
+
+    def stop(self):
+        deadline = time.monotonic() + self.grace
+        for pid in self.children:
+            self.retiring[pid] = deadline
+        self.children.clear()
+        for pid in self.retiring:
+            self.kill(pid, signal.SIGTERM)
+        while self.retiring:
+            self.reap()
+            if time.monotonic() > deadline:
+                for pid in self.retiring:
+                    self.kill(pid, signal.SIGKILL)
+                deadline = float('inf')
+            time.sleep(self.poll_interval)
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+def cache_control_rule(rule):
+   'Split a PATTERN=VALUE command line argument'
+   pattern, sep, value = rule.partition('=')
+   if not pattern or not sep or not value:
+      raise argparse.ArgumentTypeError("expected PATTERN=VALUE, got %r" % rule)
+   return pattern, value
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--bind', '-b', default='', metavar='ADDRESS',
                         help='Specify alternate bind address '
@@ -358,7 +3214,94 @@ parser.add_argument('port', action='store',
                         default=8000, type=int,
                         nargs='?',
                         help='Specify alternate port [default: 8000]')
+parser.add_argument('--threads', '-t', default=0, type=int, metavar='N',
+                        help='Serve up to N connections concurrently with '
+                             'HTTP/1.1 keep-alive [default: 0, one at a time]')
+parser.add_argument('--bulk-threads', type=int, metavar='N',
+                        help='Serve up to N bulk transfers, those beyond '
+                             '--interactive-size, on threads of their own '
+                             'so that they never hold up the others '
+                             '[default: as many as --threads]')
+parser.add_argument('--queue-size', default=64, type=int, metavar='N',
+                        help='Connections allowed to wait for a free thread '
+                             'before new ones get 503 [default: 64]')
+parser.add_argument('--backlog', default=128, type=int, metavar='N',
+                        help='Listen backlog of the server socket '
+                             '[default: 128]')
+parser.add_argument('--workers', '-w', default=0, type=int, metavar='N',
+                        help='Fork N worker processes, restarted if they '
+                             'crash; SIGHUP replaces them gracefully '
+                             '[default: 0, serve from this process]')
+parser.add_argument('--grace', default=60, type=float, metavar='SECONDS',
+                        help='How long stopping workers may take to finish '
+                             'their requests [default: 60]')
+parser.add_argument('--timeout', default=30, type=float, metavar='SECONDS',
+                        help='Close connections idle for this long '
+                             '[default: 30]')
+parser.add_argument('--listing-cache', default=32, type=float, metavar='MB',
+                        help='Memory for cached directory listings, 0 to '
+                             'disable [default: 32]')
+parser.add_argument('--cache-control', action='append', default=[],
+                        type=cache_control_rule,
+                        metavar='PATTERN=VALUE',
+                        help='Send "Cache-Control: VALUE" for files matching '
+                             'PATTERN, e.g. "*.iso=max-age=86400" or '
+                             '"/static/*=public, max-age=3600"; may be repeated')
+parser.add_argument('--no-compress', action='store_true',
+                        help='Never compress responses')
+parser.add_argument('--compress-cache', metavar='DIRECTORY',
+                        help='Keep files compressed on the fly in DIRECTORY')
+parser.add_argument('--compress-cache-size', default=256, type=float, metavar='MB',
+                        help='Disk space for --compress-cache [default: 256]')
+parser.add_argument('--thumbnail-cache', metavar='DIRECTORY',
+                        default=os.path.join(os.environ.get('XDG_CACHE_HOME')
+                                             or os.path.expanduser('~/.cache'),
+                                             'SimpleHTTPServerWithUpload', 'thumbnails'),
+                        help='Where to keep image thumbnails '
+                             '[default: %(default)s]')
+parser.add_argument('--thumbnail-cache-size', default=64, type=float, metavar='MB',
+                        help='Disk space for --thumbnail-cache [default: 64]')
+parser.add_argument('--no-thumbnails', action='store_true',
+                        help='Show full-size images in listings')
+parser.add_argument('--download-rate', default=0, type=float, metavar='MB',
+                        help='Limit downloads from the whole server to MB per '
+                             'second [default: 0, unlimited]')
+parser.add_argument('--upload-rate', default=0, type=float, metavar='MB',
+                        help='Limit uploads to the whole server to MB per '
+                             'second [default: 0, unlimited]')
+parser.add_argument('--client-download-rate', default=0, type=float, metavar='MB',
+                        help='Limit downloads of each client address to MB '
+                             'per second [default: 0, unlimited]')
+parser.add_argument('--client-upload-rate', default=0, type=float, metavar='MB',
+                        help='Limit uploads of each client address to MB per '
+                             'second [default: 0, unlimited]')
+parser.add_argument('--client-connections', default=0, type=int, metavar='N',
+                        help='Answer 429 to clients with N connections open; '
+                             'needs --threads [default: 0, unlimited]')
+parser.add_argument('--interactive-size', default=256, type=float, metavar='KB',
+                        help='Requests and responses up to this size are not '
+                             'held back by --download-rate and --upload-rate '
+                             'nor served as bulk transfers [default: 256]')
+parser.add_argument('--metrics', nargs='?', const='/metrics', metavar='PATH',
+                        help='Collect request metrics and serve them in '
+                             'Prometheus format at PATH, which hides any file '
+                             'of that name [default PATH: /metrics]')
+parser.add_argument('--log-format', choices=('common', 'json'), default='common',
+                        help='Log requests as common log lines or as one JSON '
+                             'object per line [default: common]')
+parser.add_argument('--profile', metavar='FILE',
+                        help='Sample the stacks of the serving threads and '
+                             'write them to FILE (FILE.PID with --workers) '
+                             'in collapsed format for flame graphs')
+parser.add_argument('--profile-interval', default=10, type=float, metavar='MS',
+                        help='Time between --profile samples [default: 10]')
 args = parser.parse_args()
+if args.metrics is not None and not args.metrics.startswith('/'):
+	parser.error("--metrics PATH must start with '/'")
+if args.workers > 0 and not hasattr(os, 'fork'):
+	parser.error("--workers needs os.fork(), which this platform lacks")
+if args.bulk_threads is not None and args.bulk_threads < 1:
+	parser.error("--bulk-threads must be at least 1")
 
 PORT = args.port
 BIND = args.bind
@@ -368,9 +3311,101 @@ if HOST == '':
 	HOST = 'localhost'
 
 Handler = SimpleHTTPRequestHandler
+Handler.timeout = args.timeout
+Handler.listing_cache = ListingCache(int(args.listing_cache * 1024 * 1024))
+Handler.cache_control = args.cache_control
+Handler.compress = not args.no_compress
+if args.compress_cache:
+	try:
+		Handler.compressed_cache = VariantCache(
+			os.path.abspath(args.compress_cache),
+			int(args.compress_cache_size * 1024 * 1024),
+			shared=args.workers > 0)
+	except (OSError, ValueError) as e:
+		parser.error("can't use --compress-cache %s (%s)"
+		             % (args.compress_cache, getattr(e, 'strerror', None) or e))
+if not args.no_thumbnails:
+	if Image is None:
+		print("Pillow is not installed; listings show full-size images.")
+	else:
+		try:
+			Handler.thumbnails = ThumbnailGenerator(VariantCache(
+				os.path.abspath(args.thumbnail_cache),
+				int(args.thumbnail_cache_size * 1024 * 1024),
+				shared=args.workers > 0))
+		except (OSError, ValueError) as e:
+			print("Can't use thumbnail cache %s (%s); listings show full-size images."
+			      % (args.thumbnail_cache, getattr(e, 'strerror', None) or e))
 
-with socketserver.TCPServer((BIND, PORT), Handler) as httpd:
-	serve_message = "Serving HTTP on {host} port {port} (http://{host}:{port}/) ..."
-	print(serve_message.format(host=HOST, port=PORT))
-	httpd.serve_forever()
+if args.threads > 0:
+	# Persistent connections are only worth it when an idle one can't
+	# hold up everybody else.
+	Handler.protocol_version = "HTTP/1.1"
+
+if args.metrics is not None:
+	Handler.metrics = Metrics(slots=max(1, Supervisor.slot_count(args.workers)))
+	Handler.metrics_path = args.metrics
+Handler.log_format = args.log_format
+if (args.download_rate or args.upload_rate or args.client_download_rate or
+		args.client_upload_rate or args.client_connections):
+	MB = 1024 * 1024
+	Handler.shaper = Shaper(
+		{'download': args.download_rate * MB, 'upload': args.upload_rate * MB},
+		{'download': args.client_download_rate * MB,
+		 'upload': args.client_upload_rate * MB},
+		max_connections=args.client_connections,
+		slots=max(1, Supervisor.slot_count(args.workers)),
+		lock=FileLock() if args.workers > 0 else None)
+Handler.interactive_bytes = int(args.interactive_size * 1024)
 
+serve_message = "Serving HTTP on {host} port {port} (http://{host}:{port}/) ..."
+
+def open_server(reuse_port=False):
+	return make_server((BIND, PORT), Handler,
+	                   threads=args.threads,
+	                   queue_size=args.queue_size,
+	                   backlog=args.backlog,
+	                   reuse_port=reuse_port,
+	                   bulk_threads=args.bulk_threads)
+
+def serve(httpd, slot=0):
+	if Handler.metrics is not None:
+		Handler.metrics.claim(slot)
+	if Handler.shaper is not None:
+		Handler.shaper.claim(slot)
+	sampler = None
+	if args.profile:
+		path = args.profile
+		if args.workers > 0:
+			path += '.%d' % os.getpid()
+		sampler = StackSampler(path, args.profile_interval / 1000).start()
+	try:
+		serve_until_stopped(httpd)
+	finally:
+		if sampler is not None:
+			sampler.stop()
+
+if args.workers > 0:
+	if reuse_port_supported():
+		# Every worker listens on its own socket so that the kernel
+		# balances the connections instead of waking all of them up.
+		# Binding here first, without SO_REUSEPORT, reports a port that
+		# is in use, even by another instance, before forking.
+		open_server().server_close()
+		def serve_worker(slot):
+			serve(open_server(reuse_port=True), slot)
+		httpd = None
+	else:
+		httpd = open_server()
+		def serve_worker(slot):
+			serve(httpd, slot)
+	print(serve_message.format(host=HOST, port=PORT)
+	      + " with %d worker processes" % args.workers)
+	sys.stdout.flush()
+	Supervisor(args.workers, serve_worker, grace=args.grace).run()
+	if httpd is not None:
+		httpd.server_close()
+else:
+	httpd = open_server()
+	print(serve_message.format(host=HOST, port=PORT))
+	serve(httpd)
@@ -1,4 +1,4 @@
 #!/bin/bash
 clear
 cd /mnt/shared_media
-python3 /bin/SimpleHTTPServerWithUpload.py 8080
+exec python3 /bin/SimpleHTTPServerWithUpload.py --workers "$(nproc)" --threads 16 8080
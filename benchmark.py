@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+
+"""Benchmark and load test for SimpleHTTPServerWithUpload.
+
+Starts the server on localhost against a generated fixture tree and
+drives concurrent workloads at it, reporting requests per second,
+latency percentiles, throughput and the resident memory of the server
+processes.  Results are written as JSON so that runs of different
+versions can be compared:
+
+    python3 benchmark.py --output before.json
+    (change the server)
+    python3 benchmark.py --output after.json --compare before.json
+
+The fixture tree holds many tiny files, a directory with 100k entries
+and a few multi-GB sparse files.  It is generated once and reused while
+its parameters stay the same.
+
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, 'SimpleHTTPServerWithUpload.py')
+MB = 1024 * 1024
+
+class Fixtures:
+
+    """The tree served during a benchmark, below ROOT.
+
+    tiny/DDD/FFFF.txt   TINY_FILES files of a few hundred bytes
+    huge/NNNNNN         HUGE_ENTRIES empty files in one directory
+    sparse/N.bin        SPARSE_COUNT sparse files of SPARSE_SIZE bytes
+    upload/             target of the upload workload, emptied per run
+
+    """
+
+    def __init__(self, root, tiny_files, huge_entries, sparse_count, sparse_size):
+        self.root = root
+        self.params = OrderedDict([('tiny_files', tiny_files),
+                                   ('huge_entries', huge_entries),
+                                   ('sparse_count', sparse_count),
+                                   ('sparse_size', sparse_size)])
+        self.tiny = ['/tiny/%03d/%04d.txt' % (i // 100, i % 100)
+                     for i in range(tiny_files)]
+        self.tiny_dirs = sorted(set(p.rsplit('/', 1)[0] + '/' for p in self.tiny))
+        self.sparse = ['/sparse/%d.bin' % i for i in range(sparse_count)]
+        self.sparse_size = sparse_size
+
+    def manifest(self):
+        return os.path.join(self.root, '.fixtures.json')
+
+    def create(self):
+        """Generate the tree unless it is already there.
+
+        Only a directory generated here before, recognised by its
+        manifest, is ever removed; raise RuntimeError rather than touch
+        any other non-empty directory.
+
+        """
+        try:
+            with open(self.manifest()) as f:
+                if json.load(f) == self.params:
+                    self.reset_uploads()
+                    return
+        except FileNotFoundError:
+            if os.path.isdir(self.root) and os.listdir(self.root):
+                raise RuntimeError("%s is not empty and holds no fixtures; "
+                                   "pick another --fixtures directory" % self.root)
+        except (OSError, ValueError):
+            pass
+        print("Generating fixtures in %s ..." % self.root)
+        if os.path.exists(self.manifest()):
+            shutil.rmtree(self.root)
+        for path in self.tiny:
+            name = os.path.join(self.root, path.lstrip('/'))
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name, 'w') as f:
+                f.write(('%s\n' % path) * random.randint(4, 32))
+        huge = os.path.join(self.root, 'huge')
+        os.makedirs(huge)
+        for i in range(self.params['huge_entries']):
+            open(os.path.join(huge, '%06d' % i), 'w').close()
+        os.makedirs(os.path.join(self.root, 'sparse'))
+        for path in self.sparse:
+            with open(os.path.join(self.root, path.lstrip('/')), 'wb') as f:
+                f.truncate(self.sparse_size)
+        self.reset_uploads()
+        with open(self.manifest(), 'w') as f:
+            json.dump(self.params, f)
+
+    def reset_uploads(self):
+        upload = os.path.join(self.root, 'upload')
+        if os.path.isdir(upload):
+            shutil.rmtree(upload)
+        os.makedirs(upload)
+
+class Server:
+
+    """The server under test, running in ROOT on a free local port."""
+
+    def __init__(self, root, args, log):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.args = [sys.executable, SERVER, '--bind', '127.0.0.1'] + args + [str(self.port)]
+        self.log = open(log, 'wb')
+        self.process = subprocess.Popen(self.args, cwd=root, stdout=self.log,
+                                        stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 15
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError("server exited with status %d, see %s"
+                                   % (self.process.returncode, log))
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError("server didn't start listening, see %s" % log)
+                time.sleep(0.05)
+
+    def rss(self):
+        """Resident memory of the server and its worker processes, in
+        bytes, or None where /proc isn't available."""
+        pids = [self.process.pid]
+        try:
+            parents = {}
+            for name in os.listdir('/proc'):
+                if name.isdigit():
+                    try:
+                        with open('/proc/%s/stat' % name) as f:
+                            parents[int(name)] = int(f.read().rsplit(')', 1)[1].split()[1])
+                    except (OSError, IndexError, ValueError):
+                        pass
+            pids += [pid for pid, ppid in parents.items() if ppid == self.process.pid]
+            total = 0
+            for pid in pids:
+                with open('/proc/%d/status' % pid) as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+            return total
+        except OSError:
+            return None
+
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+class Client:
+
+    """A keep-alive connection to the server, reopened after errors."""
+
+    def __init__(self, port, timeout=60):
+        self.port = port
+        self.timeout = timeout
+        self.conn = None
+        self.buf = memoryview(bytearray(MB))
+
+    def request(self, method, path, body=None, headers={}):
+        """Send a request and read the whole response.
+
+        Return (status, number of body bytes received).
+
+        """
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection('127.0.0.1', self.port,
+                                                   timeout=self.timeout)
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            received = 0
+            while True:
+                n = response.readinto(self.buf)
+                if not n:
+                    break
+                received += n
+            if response.will_close:
+                self.close()
+            return response.status, received
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+# Each workload makes one request through a Client and returns the
+# number of bytes transferred, or raises on an unexpected reply.
+
+def expect(status, expected):
+    if status != expected:
+        raise http.client.HTTPException("status %d, expected %d" % (status, expected))
+
+def get_tiny(client, fixtures, rng):
+    status, n = client.request('GET', rng.choice(fixtures.tiny))
+    expect(status, 200)
+    return n
+
+def head(client, fixtures, rng):
+    status, n = client.request('HEAD', rng.choice(fixtures.tiny + fixtures.sparse))
+    expect(status, 200)
+    return n
+
+def get_range(client, fixtures, rng):
+    first = rng.randrange(0, fixtures.sparse_size - MB)
+    status, n = client.request('GET', rng.choice(fixtures.sparse),
+                               headers={'Range': 'bytes=%d-%d' % (first, first + MB - 1)})
+    expect(status, 206)
+    return n
+
+def get_large(client, fixtures, rng):
+    status, n = client.request('GET', rng.choice(fixtures.sparse))
+    expect(status, 200)
+    return n
+
+def list_small(client, fixtures, rng):
+    status, n = client.request('GET', rng.choice(fixtures.tiny_dirs))
+    expect(status, 200)
+    return n
+
+def list_huge(client, fixtures, rng):
+    status, n = client.request('GET', '/huge/')
+    expect(status, 200)
+    return n
+
+UPLOAD_SIZE = 4 * MB
+UPLOAD_DATA = os.urandom(UPLOAD_SIZE)
+
+def upload(client, fixtures, rng):
+    boundary = '----benchmark%016x' % rng.getrandbits(64)
+    body = b''.join([
+        ('--%s\r\nContent-Disposition: form-data; name="file"; '
+         'filename="%s.bin"\r\nContent-Type: application/octet-stream\r\n\r\n'
+         % (boundary, threading.current_thread().name)).encode(),
+        UPLOAD_DATA,
+        ('\r\n--%s--\r\n' % boundary).encode()])
+    status, n = client.request('POST', '/upload/', body, {
+        'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
+        'Content-Length': str(len(body)),
+        })
+    expect(status, 200)
+    return n + len(body)
+
+WORKLOADS = OrderedDict([
+    ('get-tiny', get_tiny),
+    ('head', head),
+    ('range', get_range),
+    ('get-large', get_large),
+    ('list-small', list_small),
+    ('list-huge', list_huge),
+    ('upload', upload),
+    ])
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def run_workload(name, server, fixtures, concurrency, duration, warmup):
+    """Run workload NAME from CONCURRENCY threads for DURATION seconds,
+    after WARMUP seconds whose requests aren't counted."""
+    work = WORKLOADS[name]
+    lock = threading.Lock()
+    latencies = []
+    totals = {'bytes': 0, 'errors': 0}
+    start = time.monotonic() + warmup
+    deadline = start + duration
+
+    def loop(seed):
+        rng = random.Random(seed)
+        client = Client(server.port)
+        mine = []
+        nbytes = errors = 0
+        while True:
+            t0 = time.monotonic()
+            if t0 >= deadline:
+                break
+            try:
+                n = work(client, fixtures, rng)
+            except (OSError, http.client.HTTPException):
+                n = None
+            t1 = time.monotonic()
+            if t0 < start:
+                continue
+            if n is None:
+                errors += 1
+            else:
+                mine.append(t1 - t0)
+                nbytes += n
+        client.close()
+        with lock:
+            latencies.extend(mine)
+            totals['bytes'] += nbytes
+            totals['errors'] += errors
+
+    rss = []
+    done = threading.Event()
+    def sample():
+        while not done.wait(0.2):
+            value = server.rss()
+            if value is not None:
+                rss.append(value)
+
+    threads = [threading.Thread(target=loop, args=(i,), name='%s-%d' % (name, i))
+               for i in range(concurrency)]
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The last requests may have run past the deadline.
+    elapsed = max(duration, time.monotonic() - start)
+    done.set()
+    sampler.join()
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return OrderedDict([
+        ('concurrency', concurrency),
+        ('seconds', round(elapsed, 3)),
+        ('requests', len(latencies)),
+        ('errors', totals['errors']),
+        ('requests_per_second', round(len(latencies) / elapsed, 2)),
+        ('latency_p50_ms', ms(percentile(latencies, 0.50))),
+        ('latency_p99_ms', ms(percentile(latencies, 0.99))),
+        ('latency_max_ms', ms(latencies[-1] if latencies else None)),
+        ('megabytes_per_second', round(totals['bytes'] / MB / elapsed, 2)),
+        ('server_rss_peak_mb', round(max(rss) / MB, 1) if rss else None),
+        ('server_rss_end_mb', round(rss[-1] / MB, 1) if rss else None),
+        ])
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=HERE, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+COLUMNS = (('requests_per_second', 'req/s'),
+           ('latency_p50_ms', 'p50 ms'),
+           ('latency_p99_ms', 'p99 ms'),
+           ('megabytes_per_second', 'MB/s'),
+           ('server_rss_peak_mb', 'RSS MB'),
+           ('errors', 'errors'))
+
+def print_table(results, baseline=None):
+    print('%-12s' % 'workload' + ''.join('%14s' % title for key, title in COLUMNS))
+    for name, stats in results['workloads'].items():
+        old = (baseline or {}).get('workloads', {}).get(name)
+        cells = []
+        for key, title in COLUMNS:
+            value = stats[key]
+            cell = '-' if value is None else '%g' % value
+            if old and old.get(key) and value is not None and key != 'errors':
+                cell += ' %+.0f%%' % ((value - old[key]) * 100.0 / old[key])
+            cells.append('%14s' % cell)
+        print('%-12s' % name + ''.join(cells))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--fixtures', metavar='DIRECTORY',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'SimpleHTTPServerWithUpload-bench'),
+                        help='Where to generate the fixture tree [default: %(default)s]')
+    parser.add_argument('--tiny-files', default=10000, type=int, metavar='N',
+                        help='Number of tiny files [default: 10000]')
+    parser.add_argument('--huge-entries', default=100000, type=int, metavar='N',
+                        help='Entries in the huge directory [default: 100000]')
+    parser.add_argument('--sparse-files', default=2, type=int, metavar='N',
+                        help='Number of sparse files [default: 2]')
+    parser.add_argument('--sparse-size', default=4, type=float, metavar='GB',
+                        help='Size of each sparse file [default: 4]')
+    parser.add_argument('--server-args', default='--threads 16', metavar='ARGS',
+                        help='Server options, e.g. --server-args="--workers 4 '
+                             '--threads 16" [default: %(default)s]')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), metavar='LIST',
+                        help='Comma-separated workloads to run [default: %(default)s]')
+    parser.add_argument('--concurrency', '-c', default=8, type=int, metavar='N',
+                        help='Concurrent clients per workload [default: 8]')
+    parser.add_argument('--duration', '-d', default=10, type=float, metavar='SECONDS',
+                        help='Measured time per workload [default: 10]')
+    parser.add_argument('--warmup', default=1, type=float, metavar='SECONDS',
+                        help='Unmeasured time before each workload [default: 1]')
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='Write the results as JSON to FILE '
+                             '[default: benchmark-REVISION-TIME.json]')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Show the change from the results in FILE')
+    args = parser.parse_args()
+
+    names = [name for name in args.workloads.split(',') if name]
+    for name in names:
+        if name not in WORKLOADS:
+            parser.error("unknown workload %r, choose from %s" % (name, ', '.join(WORKLOADS)))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    fixtures = Fixtures(os.path.abspath(args.fixtures), args.tiny_files,
+                        args.huge_entries, args.sparse_files,
+                        int(args.sparse_size * 1024 ** 3))
+    try:
+        fixtures.create()
+    except RuntimeError as e:
+        parser.error(str(e))
+    revision = git_revision()
+    results = OrderedDict([
+        ('revision', revision),
+        ('time', datetime.datetime.now().isoformat(timespec='seconds')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('cpus', os.cpu_count()),
+        ('server_args', args.server_args),
+        ('fixtures', fixtures.params),
+        ('workloads', OrderedDict()),
+        ])
+    server = Server(fixtures.root, shlex.split(args.server_args),
+                    os.path.join(fixtures.root, '.server.log'))
+    try:
+        results['server_rss_idle_mb'] = round((server.rss() or 0) / MB, 1)
+        for name in names:
+            print("Running %s for %gs with %d clients ..."
+                  % (name, args.duration, args.concurrency))
+            results['workloads'][name] = run_workload(
+                name, server, fixtures, args.concurrency, args.duration, args.warmup)
+    finally:
+        server.stop()
+
+    print()
+    print_table(results, baseline)
+    output = args.output or 'benchmark-%s-%s.json' % (
+        revision or 'unknown', datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
+    print("\nResults written to %s" % output)
+
+if __name__ == '__main__':
+    main()